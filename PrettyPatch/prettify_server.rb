@@ -0,0 +1,40 @@
+#!/usr/bin/env ruby
+
+# Converts many patches to HTML in one process.
+#
+# Each request on stdin is a line with the patch's length in bytes, followed by the patch.
+# Each response on stdout is a line with the HTML's length in bytes, followed by the HTML,
+# which is what prettify.rb prints for the same patch. Exceptions are rendered as HTML, as
+# with prettify.rb --html-exceptions, so that one bad patch doesn't end the batch.
+
+require 'pathname'
+require 'cgi'
+
+$LOAD_PATH << Pathname.new(__FILE__).dirname.realpath.to_s
+
+require 'PrettyPatch'
+
+BACKTRACE_SEPARATOR = "\n\tfrom "
+
+$stdin.binmode
+$stdout.binmode
+
+while header = $stdin.gets
+    length = Integer(header.strip)
+    patch_data = length > 0 ? $stdin.read(length) : ""
+    patch_data.force_encoding(Encoding.default_external)
+
+    begin
+        html = PrettyPatch.prettify(patch_data)
+        html += "\n" unless html.end_with?("\n")
+    rescue => exception
+        backtrace = exception.backtrace
+        backtrace[0] += ": " + exception.to_s + " (" + exception.class.to_s + ")"
+        html = "<pre>\n" + CGI.escapeHTML(backtrace.join(BACKTRACE_SEPARATOR)) + "\n</pre>\n"
+    end
+
+    html = html.b
+    $stdout.write("#{html.bytesize}\n")
+    $stdout.write(html)
+    $stdout.flush
+end
@@ -0,0 +1,94 @@
+""" Grouping of near-duplicate answers.
+
+    Each answer is normalized to its lower-cased words, so that answers that differ
+    only in case, whitespace or punctuation are duplicates. Two answers are
+    near-duplicates if the Jaccard similarity of their shingle sets (their words
+    and pairs of adjacent words) is at least `MIN_JACCARD`; changing one word of a
+    15-word answer leaves a similarity of about 0.8.
+
+    Candidate pairs are found by banded MinHash: each answer's signature is the
+    minimum of `NUM_HASHES` hash functions over its shingles, split into `BANDS`
+    bands, and only answers that agree on a whole band are compared. Two answers
+    with a similarity of `MIN_JACCARD` share a band with probability
+    1 - (1 - 0.75 ** ROWS) ** BANDS > 0.99.
+"""
+
+import re
+import zlib
+from collections import defaultdict
+
+import numpy as np
+
+MIN_JACCARD = 0.75
+NUM_HASHES = 64
+BANDS = 16
+ROWS = NUM_HASHES // BANDS
+
+# The hash functions are h(x) = (a * x + b) mod p, on 31-bit shingle hashes, so the products fit in 64 bits.
+_PRIME = (1 << 31) - 1
+_hash_params = np.random.RandomState(1).randint(1, _PRIME, size=(2, NUM_HASHES, 1)).astype(np.uint64)
+_HASH_A, _HASH_B = _hash_params
+
+
+def normalize_answer(text):
+    """Returns the lower-cased words of `text`, separated by single spaces."""
+    return ' '.join(re.findall(r'\w+', text.lower(), re.UNICODE))
+
+
+def shingles(text):
+    """Returns the set of hashes of the words and adjacent word pairs of the normalized `text`."""
+    words = text.split()
+    return {zlib.crc32(shingle.encode('utf-8')) & _PRIME
+            for shingle in words + [' '.join(pair) for pair in zip(words, words[1:])]}
+
+
+def minhash(shingle_set):
+    """Returns the MinHash signature of a non-empty set of shingle hashes, as an array of `NUM_HASHES` ints."""
+    values = np.fromiter(shingle_set, dtype=np.uint64, count=len(shingle_set))
+    return ((_HASH_A * values + _HASH_B) % _PRIME).min(axis=1)
+
+
+def jaccard(a, b):
+    return len(a & b) / float(len(a | b))
+
+
+def cluster_texts(texts):
+    """Returns a list of clusters of near-duplicate `texts`. Each cluster is a list of indices
+    into `texts`, in ascending order; clusters are ordered by their first index.
+
+    Texts that are equal after normalization are always in the same cluster."""
+    normalized = [normalize_answer(text) for text in texts]
+
+    # Exact duplicates share one signature, and are merged before any banding.
+    first_index = {}
+    parent = range(len(texts))
+    for idx, text in enumerate(normalized):
+        parent[idx] = first_index.setdefault(text, idx)
+
+    def find(idx):
+        while parent[idx] != idx:
+            parent[idx] = parent[parent[idx]]
+            idx = parent[idx]
+        return idx
+
+    def union(a, b):
+        a, b = find(a), find(b)
+        if a != b:
+            parent[max(a, b)] = min(a, b)
+
+    shingle_sets = {idx: shingles(text) for text, idx in first_index.items() if text}
+    buckets = defaultdict(list)
+    for idx, shingle_set in shingle_sets.items():
+        signature = minhash(shingle_set)
+        for band in range(BANDS):
+            buckets[band, signature[band * ROWS:(band + 1) * ROWS].tostring()].append(idx)
+    for bucket in buckets.values():
+        for i, a in enumerate(bucket):
+            for b in bucket[i + 1:]:
+                if find(a) != find(b) and jaccard(shingle_sets[a], shingle_sets[b]) >= MIN_JACCARD:
+                    union(a, b)
+
+    clusters = defaultdict(list)
+    for idx in range(len(texts)):
+        clusters[find(idx)].append(idx)
+    return [clusters[root] for root in sorted(clusters)]
@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+
+""" Benchmarks the stages of extract_answers_template.py on a synthetic class.
+
+    Student notebooks are generated from a template notebook: each student answers
+    the questions with random text, some answers are shared by several students,
+    some question cells are edited, and code cells have outputs of a given size.
+    The notebooks are served by a local HTTP server, and the extractor's fetch,
+    match, dedup, write and HTML stages are timed separately.
+
+    The results are written as JSON. With --baseline, they are compared with the
+    results of a previous run, and the exit status is 1 if any stage got slower
+    by more than --tolerance.
+"""
+
+import argparse
+import BaseHTTPServer
+import copy
+import json
+import os
+import random
+import resource
+import shutil
+import SocketServer
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+
+import extract_answers_template
+from disk_cache import CacheStore
+from extract_answers_template import NotebookExtractor, NotebookUtils
+from notebook_html import render_notebook_html
+
+PROJECT_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+DEFAULT_TEMPLATE = os.path.join(PROJECT_DIR, 'processed_notebooks', 'day6_reading_journal.ipynb')
+
+STAGES = ['fetch', 'match', 'dedup', 'write', 'html']
+RESULTS_VERSION = 1
+
+
+#
+# Synthetic class
+#
+
+def template_vocabulary(template):
+    words = set()
+    for cell in template['cells']:
+        words.update(word for word in ''.join(cell['source']).split() if word.isalpha())
+    return sorted(words) or ['answer']
+
+
+def edit_text(rng, text, edits):
+    """Returns `text` with `edits` random single-character insertions, deletions and substitutions."""
+    chars = list(text)
+    for _ in range(edits):
+        pos = rng.randrange(len(chars) + 1)
+        op = rng.choice(['insert', 'delete', 'substitute']) if pos < len(chars) else 'insert'
+        if op == 'insert':
+            chars.insert(pos, rng.choice('abcdefghijklmnopqrstuvwxyz '))
+        elif op == 'delete':
+            del chars[pos]
+        else:
+            chars[pos] = rng.choice('abcdefghijklmnopqrstuvwxyz ')
+    return ''.join(chars)
+
+
+def synthesize_notebook(template, rng, vocabulary, shared_answers, options):
+    """Returns a student notebook: a copy of `template` with an answer after each question.
+
+    An answer is one of `shared_answers` with probability `options.shared_answer_rate`; else it is
+    `options.answer_words` random words from `vocabulary`. Question cells are edited with
+    probability `options.edit_rate`. Code cells get outputs of `options.output_bytes` bytes."""
+    nb = copy.deepcopy(template)
+    cells = []
+    for cell in nb['cells']:
+        if cell['cell_type'] == 'code':
+            cell['source'] = ['result = compute()\n', 'print result']
+            cell['outputs'] = [{'name': 'stdout',
+                                'output_type': 'stream',
+                                'text': ['x' * (options.output_bytes - 1) + '\n']}] if options.output_bytes else []
+            cell['execution_count'] = 1
+        cells.append(cell)
+        if not cell['metadata'].get('is_question', False):
+            continue
+        if rng.random() < options.edit_rate:
+            source = ''.join(cell['source'])
+            cell['source'] = edit_text(rng, source, max(1, len(source) // 50)).splitlines(True)
+        if rng.random() < options.shared_answer_rate:
+            answer = rng.choice(shared_answers)
+        else:
+            answer = ' '.join(rng.choice(vocabulary) for _ in range(options.answer_words))
+        cells.append(NotebookUtils.markdown_text_cell(answer))
+    nb['cells'] = cells
+    return nb
+
+
+def synthesize_class(template, class_size, options):
+    """Returns a dictionary {github_username -> notebook or None}. A fraction
+    `options.missing_rate` of the students have no notebook."""
+    rng = random.Random(options.seed)
+    vocabulary = template_vocabulary(template)
+    shared_answers = [' '.join(rng.choice(vocabulary) for _ in range(options.answer_words)) for _ in range(5)]
+    notebooks = {}
+    for idx in range(class_size):
+        gh_username = 'student%03d' % idx
+        if rng.random() < options.missing_rate:
+            notebooks[gh_username] = None
+        else:
+            notebooks[gh_username] = synthesize_notebook(template, rng, vocabulary, shared_answers, options)
+    return notebooks
+
+
+#
+# Local stand-in for raw.githubusercontent.com
+#
+
+class NotebookRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, as the real server
+    wbufsize = -1  # send each response in one write; handle_one_request flushes it
+
+    def do_GET(self):
+        body = self.server.documents.get(self.path)
+        status = 200 if body is not None else 404
+        body = body if body is not None else 'Not Found'
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class NotebookServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ Serves `documents`, a dictionary {path -> body}, from a thread, on a free local port. """
+    daemon_threads = True
+    request_queue_size = 128  # the default of 5 drops the SYNs of concurrent fetches, which retry after 1s
+
+    def __init__(self, documents):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), NotebookRequestHandler)
+        self.documents = documents
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self.server_port, path)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+#
+# Measurement
+#
+
+def rss_megabytes():
+    """Returns the current resident set size of this process; or its peak, where that's not available."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 2.0 ** 20
+    except (IOError, IndexError, ValueError):
+        return peak_rss_megabytes()
+
+
+def peak_rss_megabytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2.0 ** 20 if sys.platform == 'darwin' else peak / 2.0 ** 10  # bytes on OS X; else KB
+
+
+@contextmanager
+def measure(results, stage, quiet=True):
+    """Records the wall time, CPU time and memory use of the enclosed block in `results[stage]`.
+
+    With `quiet`, the block's output to stdout is discarded."""
+    stdout = sys.stdout
+    if quiet:
+        sys.stdout = open(os.devnull, 'w')
+    rss_before = rss_megabytes()
+    cpu_before = time.clock()
+    wall_before = time.time()
+    try:
+        yield
+    finally:
+        wall = time.time() - wall_before
+        cpu = time.clock() - cpu_before
+        if quiet:
+            sys.stdout.close()
+            sys.stdout = stdout
+    results[stage] = {'wall_seconds': wall,
+                      'cpu_seconds': cpu,
+                      'rss_delta_megabytes': rss_megabytes() - rss_before,
+                      'peak_rss_megabytes': peak_rss_megabytes()}
+
+
+class BenchmarkExtractor(NotebookExtractor):
+    """ A `NotebookExtractor` whose `extract` uses notebooks that were already fetched. """
+
+    fetched_notebooks = None
+
+    def fetch_notebooks(self):
+        if self.fetched_notebooks is not None:
+            return self.fetched_notebooks
+        return NotebookExtractor.fetch_notebooks(self)
+
+
+def run_stages(template_path, notebooks, output_dir, jobs):
+    """Runs the extractor's stages on `notebooks`, served over HTTP. Returns {stage -> measurements}."""
+    template_name = os.path.basename(template_path)
+    documents = {'/%s/%s' % (gh_username, template_name): json.dumps(nb)
+                 for gh_username, nb in notebooks.items() if nb is not None}
+    server = NotebookServer(documents)
+    try:
+        gh_usernames = sorted(notebooks)
+        users_df = pd.DataFrame({'gh_username': gh_usernames,
+                                 'Full Name': ['Student %s' % u for u in gh_usernames],
+                                 'notebook_urls': [server.url('/%s/%s' % (u, template_name)) for u in gh_usernames]})
+
+        extract_answers_template.PROCESSED_NOTEBOOK_DIR = output_dir
+        extract_answers_template.SUMMARY_DIR = output_dir
+        extract_answers_template.html_chunk_cache = CacheStore(os.path.join(output_dir, 'html_chunks'))
+        nbe = BenchmarkExtractor(users_df, template_path, jobs=jobs)
+
+        results = {}
+        with measure(results, 'fetch'):
+            nbe.fetched_notebooks = nbe.fetch_notebooks()
+        results['fetch']['bytes'] = sum(len(body) for body in documents.values())
+        with measure(results, 'match'):
+            nbe.extract()
+        with measure(results, 'dedup'):
+            for prompt in nbe.question_prompts:
+                prompt.answer_clusters()
+        with measure(results, 'write'):
+            nbe.write_notebook(include_html=False)
+            nbe.write_answer_counts()
+            nbe.write_poll_results()
+        with measure(results, 'html'):
+            chunks = [list(nbe.prompt_output_cells(prompt)) for prompt in nbe.question_prompts]
+            render_notebook_html(nbe.template.get('metadata', {}), chunks,
+                                 store=extract_answers_template.html_chunk_cache, processes=jobs)
+        return results
+    finally:
+        server.stop()
+
+
+def median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    return values[mid] if len(values) % 2 else (values[mid - 1] + values[mid]) / 2.0
+
+
+def run_benchmark(options):
+    with open(options.template) as f:
+        template = json.load(f)
+    runs = []
+    for class_size in options.class_sizes:
+        notebooks = synthesize_class(template, class_size, options)
+        repeats = []
+        for _ in range(options.repeat):
+            output_dir = tempfile.mkdtemp(prefix='benchmark_extraction')
+            try:
+                repeats.append(run_stages(options.template, notebooks, output_dir, options.jobs))
+            finally:
+                shutil.rmtree(output_dir)
+        stages = {stage: {key: median([results[stage][key] for results in repeats])
+                          for key in repeats[0][stage]}
+                  for stage in STAGES}
+        stage_times = '  '.join('{} {:.3f}s'.format(stage, stages[stage]['wall_seconds']) for stage in STAGES)
+        print "class size {:4d}: {}".format(class_size, stage_times)
+        runs.append({'class_size': class_size, 'stages': stages})
+    return {'version': RESULTS_VERSION,
+            'options': {key: value for key, value in vars(options).items()
+                        if key not in ('output', 'baseline', 'tolerance', 'min_seconds')},
+            'runs': runs}
+
+
+def compare_with_baseline(results, baseline, tolerance, min_seconds):
+    """Returns a list of regression messages: stages whose wall time grew by more than `tolerance`
+    (a fraction) and `min_seconds`, relative to the run with the same class size in `baseline`."""
+    baseline_runs = {run['class_size']: run for run in baseline['runs']}
+    regressions = []
+    for run in results['runs']:
+        baseline_run = baseline_runs.get(run['class_size'])
+        if baseline_run is None:
+            continue
+        for stage in STAGES:
+            if stage not in baseline_run['stages']:
+                continue
+            before = baseline_run['stages'][stage]['wall_seconds']
+            after = run['stages'][stage]['wall_seconds']
+            if after > before * (1 + tolerance) and after - before > min_seconds:
+                regressions.append("class size {}: {} took {:.3f}s; the baseline took {:.3f}s".format(
+                    run['class_size'], stage, after, before))
+    return regressions
+
+
+def comma_separated_ints(value):
+    return [int(item) for item in value.split(',')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the notebook extraction stages on a synthetic class.')
+    parser.add_argument('--template', type=str, default=DEFAULT_TEMPLATE, metavar='JUPYTER_NOTEBOOK_FILE')
+    parser.add_argument('--class-sizes', type=comma_separated_ints, default=[25, 100], metavar='N,N,...')
+    parser.add_argument('--answer-words', type=int, default=60, metavar='N', help='words per answer')
+    parser.add_argument('--shared-answer-rate', type=float, default=0.2,
+                        help='fraction of answers that are copies of a few common answers')
+    parser.add_argument('--edit-rate', type=float, default=0.1,
+                        help='fraction of question cells that students edited')
+    parser.add_argument('--missing-rate', type=float, default=0.05,
+                        help='fraction of students without a notebook')
+    parser.add_argument('--output-bytes', type=int, default=1024, metavar='N', help='size of each code cell output')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--jobs', type=int, default=1, metavar='N', help='as for extract_answers_template.py')
+    parser.add_argument('--repeat', type=int, default=3, metavar='N', help='report the median of N runs')
+    parser.add_argument('--output', type=str, metavar='JSON_FILE', help='write the results here')
+    parser.add_argument('--baseline', type=str, metavar='JSON_FILE', help='results of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='fraction by which a stage may be slower than the baseline')
+    parser.add_argument('--min-seconds', type=float, default=0.05,
+                        help='ignore slowdowns smaller than this, which are mostly noise')
+    args = parser.parse_args()
+
+    results = run_benchmark(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print "Wrote", args.output
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_with_baseline(results, json.load(f), args.tolerance, args.min_seconds)
+        for message in regressions:
+            print >> sys.stderr, "Regression:", message
+        if regressions:
+            sys.exit(1)
+        print "No regressions relative to", args.baseline
@@ -0,0 +1,232 @@
+""" Approximate matching of question text against the cells of a notebook.
+
+    A `CellIndex` is built once per notebook. It indexes the cells by length and
+    by a cheap character-count fingerprint, so that a lookup only computes edit
+    distances for the few cells that could possibly be within the threshold.
+
+    `CellIndex.align` maps a whole sequence of texts (the question cells of a
+    template, in template order) onto the cells in a single monotonic alignment.
+"""
+
+import hashlib
+from bisect import bisect_left, bisect_right
+from collections import Counter, defaultdict
+
+# Characters whose counts make up a cell's fingerprint. Each edit operation changes
+# the fingerprint's L1 norm by at most 2, so half the L1 difference between two
+# fingerprints is a lower bound on the edit distance between the two strings.
+FINGERPRINT_CHARS = u'\n #*etaoinsr'
+
+
+def cell_source(cell):
+    return u''.join(cell['source'])
+
+
+def source_hash(text):
+    """A stable digest of a cell's joined source."""
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def fingerprint(text):
+    return tuple(text.count(c) for c in FINGERPRINT_CHARS)
+
+
+def fingerprint_distance_bound(fp1, fp2):
+    """A lower bound on the edit distance between two strings with these fingerprints."""
+    return (sum(abs(a - b) for a, b in zip(fp1, fp2)) + 1) // 2
+
+
+def bounded_distance(s1, s2, max_distance):
+    """Returns the Levenshtein distance between `s1` and `s2`; or None if it exceeds `max_distance`.
+
+    Only a band of width `2 * max_distance + 1` around the diagonal of the edit
+    matrix is computed, and the computation stops as soon as every entry in the
+    current row exceeds `max_distance`."""
+    if s1 == s2:
+        return 0
+    if abs(len(s1) - len(s2)) > max_distance:
+        return None
+
+    # Common prefixes and suffixes don't contribute to the distance.
+    prefix = 0
+    limit = min(len(s1), len(s2))
+    while prefix < limit and s1[prefix] == s2[prefix]:
+        prefix += 1
+    suffix = 0
+    limit -= prefix
+    while suffix < limit and s1[-1 - suffix] == s2[-1 - suffix]:
+        suffix += 1
+    s1 = s1[prefix:len(s1) - suffix]
+    s2 = s2[prefix:len(s2) - suffix]
+    if len(s1) > len(s2):
+        s1, s2 = s2, s1
+    n1, n2 = len(s1), len(s2)
+    if n1 == 0:
+        return n2 if n2 <= max_distance else None
+
+    k = max_distance
+    inf = k + 1
+    width = 2 * k + 1
+    # row[d] holds the distance between s1[:i] and s2[:j], where j = i - k + d.
+    row = [d - k if 0 <= d - k <= n2 else inf for d in range(width)]
+    for i in range(1, n1 + 1):
+        c1 = s1[i - 1]
+        new_row = [inf] * width
+        row_min = inf
+        for d in range(width):
+            j = i - k + d
+            if j < 0 or j > n2:
+                continue
+            if j == 0:
+                value = i
+            else:
+                value = row[d] + (c1 != s2[j - 1])
+                if d + 1 < width and row[d + 1] + 1 < value:
+                    value = row[d + 1] + 1
+                if d > 0 and new_row[d - 1] + 1 < value:
+                    value = new_row[d - 1] + 1
+            if value > inf:
+                value = inf
+            new_row[d] = value
+            if value < row_min:
+                row_min = value
+        if row_min > k:
+            return None
+        row = new_row
+    distance = row[n2 - n1 + k]
+    return distance if distance <= k else None
+
+
+class CellIndex(object):
+    """ An index of a notebook's cells, for finding the cell closest to a piece of text. """
+
+    def __init__(self, cells):
+        self.cells = cells
+        self.sources = [cell_source(cell) for cell in cells]
+        # number of lookups resolved by the 'exact' and the 'fuzzy' path, and of edit 'distance' computations
+        self.stats = Counter()
+        self._hash_indices = defaultdict(list)  # source hash -> ascending cell indices
+        for idx, source in enumerate(self.sources):
+            self._hash_indices[source_hash(source)].append(idx)
+        self.fingerprints = [None] * len(cells)  # computed lazily; most cells are pruned by length
+        by_length = sorted((len(source), idx) for idx, source in enumerate(self.sources))
+        self._lengths = [length for length, _ in by_length]
+        self._length_order = [idx for _, idx in by_length]
+
+    def __len__(self):
+        return len(self.cells)
+
+    def _fingerprint(self, idx):
+        fp = self.fingerprints[idx]
+        if fp is None:
+            fp = self.fingerprints[idx] = fingerprint(self.sources[idx])
+        return fp
+
+    def candidates(self, text, max_distance, start=0):
+        """Returns the indices, in notebook order, of cells at or after `start` whose length
+        is within `max_distance` of the length of `text`."""
+        lo = bisect_left(self._lengths, len(text) - max_distance)
+        hi = bisect_right(self._lengths, len(text) + max_distance)
+        return sorted(idx for idx in self._length_order[lo:hi] if idx >= start)
+
+    def find_exact(self, text_hash, start=0, exclude=()):
+        """Returns the index of the first cell at or after `start`, and not in `exclude`, whose
+        source has the digest `text_hash`; or None."""
+        indices = self._hash_indices.get(text_hash, [])
+        for idx in indices[bisect_left(indices, start):]:
+            if idx not in exclude:
+                return idx
+        return None
+
+    def find_all(self, text, max_distance, text_hash=None):
+        """Returns a list of `(index, distance)`, in notebook order, of the cells within
+        `max_distance` of `text`.
+
+        If some cells are unmodified copies of `text`, only those cells are returned."""
+        exact_indices = self._hash_indices.get(text_hash or source_hash(text))
+        if exact_indices:
+            self.stats['exact'] += 1
+            return [(idx, 0) for idx in exact_indices]
+        self.stats['fuzzy'] += 1
+        matches = []
+        text_fp = None
+        for idx in self.candidates(text, max_distance):
+            if text_fp is None:
+                text_fp = fingerprint(text)
+            if fingerprint_distance_bound(text_fp, self._fingerprint(idx)) > max_distance:
+                continue
+            self.stats['distance'] += 1
+            distance = bounded_distance(text, self.sources[idx], max_distance)
+            if distance is not None:
+                matches.append((idx, distance))
+        return matches
+
+    def align(self, texts, max_distance, text_hashes=None):
+        """Returns a list with the index of the cell matched to each of `texts`, or None for
+        texts that aren't matched.
+
+        Matched cell indices strictly increase with the position of the text in `texts`.
+        Among such alignments, the one that matches the most texts wins; then the one with
+        the least total edit distance; then the one that uses the earliest cells.
+
+        This is a dynamic program over the texts. The frontier holds, for each cell that the
+        last matched text could end on, the best alignment so far; it is pruned to a staircase
+        in which costs strictly decrease as cell indices increase."""
+        text_hashes = text_hashes or [None] * len(texts)
+        # A frontier node is (cell index, (skipped texts, total distance), parent node, text index).
+        frontier = [(-1, (0, 0), None, None)]
+        for text_idx, (text, text_hash) in enumerate(zip(texts, text_hashes)):
+            frontier_cells = [node[0] for node in frontier]
+            matched = []
+            for cell_idx, distance in self.find_all(text, max_distance, text_hash):
+                pos = bisect_left(frontier_cells, cell_idx)
+                if pos == 0:
+                    continue
+                prev = frontier[pos - 1]
+                skipped, total = prev[1]
+                matched.append((cell_idx, (skipped, total + distance), prev, text_idx))
+            skipped_nodes = [(node_cell_idx, (n_skipped + 1, dist), parent, node_text_idx)
+                             for node_cell_idx, (n_skipped, dist), parent, node_text_idx in frontier]
+            frontier = []
+            for node in sorted(skipped_nodes + matched, key=lambda node: (node[0], node[1])):
+                if not frontier or node[1] < frontier[-1][1]:
+                    frontier.append(node)
+
+        alignment = [None] * len(texts)
+        node = min(frontier, key=lambda node: node[1])
+        while node is not None:
+            cell_idx, _, parent, text_idx = node
+            if text_idx is not None:
+                alignment[text_idx] = cell_idx
+            node = parent
+        return alignment
+
+    def find_closest(self, text, max_distance, start=0, text_hash=None, exclude=()):
+        """Returns `(index, distance)` of the cell closest to `text`, or None if no cell is within
+        `max_distance`. Only cells at or after `start`, and not in the set `exclude`, are considered.
+
+        Ties are broken in favor of the earliest cell, as with `numpy.argmin` over the distances.
+        An unmodified cell is found by its digest without computing any edit distances;
+        `text_hash` saves recomputing the digest of `text`."""
+        exact_idx = self.find_exact(text_hash or source_hash(text), start, exclude)
+        if exact_idx is not None:
+            self.stats['exact'] += 1
+            return exact_idx, 0
+        self.stats['fuzzy'] += 1
+        best = None
+        text_fp = None
+        for idx in self.candidates(text, max_distance, start):
+            if idx in exclude:
+                continue
+            cap = max_distance if best is None else best[1] - 1
+            if abs(len(self.sources[idx]) - len(text)) > cap:
+                continue
+            if text_fp is None:
+                text_fp = fingerprint(text)
+            if fingerprint_distance_bound(text_fp, self._fingerprint(idx)) > cap:
+                continue
+            self.stats['distance'] += 1
+            distance = bounded_distance(text, self.sources[idx], cap)
+            if distance is not None:
+                best = (idx, distance)
+        return best
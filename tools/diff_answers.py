@@ -7,7 +7,12 @@ import json
 import os
 import sys
 from multiprocessing import Pool
-from extract_answers_template import get_user_repo_urls, get_user_notebook_urls, read_json_from_url
+
+import pandas as pd
+
+from extract_answers_template import PROCESSED_NOTEBOOK_DIR, get_github_user_notebook_url, read_json_from_url
+
+template_cell_keys = None  # set in each worker by `p_init_worker`
 
 
 def get_output_string(output):
@@ -26,31 +31,51 @@ def get_cell_eq_key(cell):
 def cell_is_keeper(cell):
     return bool(cell['metadata'].get('is_question', None))
 
+
+def p_init_worker(cell_keys):
+    global template_cell_keys
+    template_cell_keys = cell_keys
+
+
+def p_diff_notebook(args):
+    """Fetches a student notebook, removes the template's cells, and writes the rest to `output_path`.
+
+    `args` is a tuple `(notebook_url, output_path)`. Returns `output_path`; or None if the notebook
+    isn't available. This runs in a worker, so that only the workers' current notebooks are in memory."""
+    notebook_url, output_path = args
+    nb = read_json_from_url(notebook_url)
+    if not nb:
+        return None
+    nb['cells'] = [cell for cell in nb['cells']
+                   if get_cell_eq_key(cell) not in template_cell_keys]
+    with open(output_path, 'w') as f:
+        json.dump(nb, f)
+    return output_path
+
+
 if __name__ == '__main__':
     if len(sys.argv) != 3:
         print "USAGE: ./diff_answers.py gh_users.csv template_nb_file"
         sys.exit(-1)
 
-    user_repo_urls = get_user_repo_urls(sys.argv[1])
+    gh_usernames = pd.read_csv(sys.argv[1])['gh_username']
     template_nb_path = sys.argv[2]
-    notebook_urls = get_user_notebook_urls(user_repo_urls, template_nb_path)
     with open(template_nb_path) as f:
         template = json.load(f)
 
-    template_cell_indices = set(get_cell_eq_key(cell)
-                                for cell in template['cells']
-                                if not cell_is_keeper(cell))
-
-    p = Pool(20)
-    for notebook_url, nb in zip(notebook_urls, p.map(read_json_from_url, notebook_urls)):
-        if not nb:
-            continue
-        # TODO preserve the name from the list of users
-        github_username = notebook_url.split('/')[3]
-        nb['cells'] = [cell for cell in nb['cells']
-                       if get_cell_eq_key(cell) not in template_cell_indices]
-        root, ext = os.path.splitext(os.path.basename(template_nb_path))
-        output_path = 'processed_notebooks/{}_{}{}'.format(root, github_username, ext)
-        print 'writing', output_path
-        with open(output_path, 'w') as f:
-            json.dump(nb, f)
+    template_cell_keys = set(get_cell_eq_key(cell)
+                             for cell in template['cells']
+                             if not cell_is_keeper(cell))
+
+    root, ext = os.path.splitext(os.path.basename(template_nb_path))
+    tasks = [(get_github_user_notebook_url(gh_username, template_nb_path, 'ReadingJournal'),
+              os.path.join(PROCESSED_NOTEBOOK_DIR, '{}_{}{}'.format(root, gh_username, ext)))
+             for gh_username in gh_usernames]
+
+    # Each notebook is diffed and written as soon as it arrives, in whichever order they complete.
+    p = Pool(20, initializer=p_init_worker, initargs=(template_cell_keys,))
+    for output_path in p.imap_unordered(p_diff_notebook, tasks):
+        if output_path:
+            print 'wrote', output_path
+    p.close()
+    p.join()
@@ -1,39 +1,222 @@
 import hashlib
 import os
 import pickle
+import struct
+import tempfile
+import threading
+import time
+import zlib
 
+ENTRY_SUFFIX = '.cache'
+# Each entry file starts with a header: the expiry time (0 for none), and whether the payload is compressed.
+HEADER = struct.Struct('!dB')
 
-def disk_cache(active_fn=lambda: True, cache_dir='./_cache'):
+
+class CacheStore(object):
+    """ A directory of pickled values, one file per key.
+
+        Writes go to a temporary file that is renamed into place, so that concurrent
+        readers (e.g. `Pool` workers) never see a partially written entry.
+        When the store exceeds `max_entries` or `max_bytes`, the least recently used
+        entries are evicted. Entries older than their `ttl` (in seconds) are misses. """
+
+    def __init__(self, cache_dir, max_entries=None, max_bytes=None, ttl=None, compress=False):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.compress = compress
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ENTRY_SUFFIX)
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self._hits += 1
+            else:
+                self._misses += 1
+
+    def get(self, key):
+        """Returns `(True, value)` if `key` is in the store and hasn't expired; else `(False, None)`."""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            expires_at, compressed = HEADER.unpack_from(data)
+            if expires_at and expires_at < time.time():
+                self.delete(key)
+                raise KeyError(key)
+            payload = data[HEADER.size:]
+            value = pickle.loads(zlib.decompress(payload) if compressed else payload)
+        except (IOError, OSError, KeyError, struct.error, zlib.error, EOFError, pickle.UnpicklingError):
+            self._count(hit=False)
+            return False, None
+        try:
+            os.utime(path, None)  # the mtime records the most recent use, for LRU eviction
+        except OSError:
+            pass
+        self._count(hit=True)
+        return True, value
+
+    def put(self, key, value, ttl=None):
+        """Stores `value` under `key`. `ttl` overrides the store's default time-to-live."""
+        ttl = self.ttl if ttl is None else ttl
+        payload = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if self.compress:
+            payload = zlib.compress(payload)
+        data = HEADER.pack(time.time() + ttl if ttl else 0, self.compress) + payload
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                pass
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp_path, self._path(key))
+        except:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        if self.max_entries is not None or self.max_bytes is not None:
+            self.evict()
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _entries(self):
+        """Returns a list of `(mtime, size, path)`, least recently used first."""
+        entries = []
+        try:
+            names = os.listdir(self.cache_dir)
+        except OSError:
+            return entries
+        for name in names:
+            if not name.endswith(ENTRY_SUFFIX):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue  # removed by another process
+            entries.append((st.st_mtime, st.st_size, path))
+        return sorted(entries)
+
+    def evict(self):
+        """Removes least recently used entries until the store is within its entry and byte budgets."""
+        entries = self._entries()
+        total_bytes = sum(size for _, size, _ in entries)
+        while entries and ((self.max_entries is not None and len(entries) > self.max_entries) or
+                           (self.max_bytes is not None and total_bytes > self.max_bytes)):
+            _, size, path = entries.pop(0)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total_bytes -= size
+
+    def stats(self):
+        """Returns a dict with this process's hit and miss counts, and the store's entry and byte counts."""
+        entries = self._entries()
+        return {'hits': self._hits,
+                'misses': self._misses,
+                'entries': len(entries),
+                'bytes': sum(size for _, size, _ in entries)}
+
+
+def default_file_mode():
+    """Returns the mode that `open` gives a new file: 0666, less the process's umask.
+
+    `tempfile.mkstemp` creates files that only their owner can read; a file that's written to a
+    temporary file and renamed into place for other users (e.g. the web app) should be given this mode."""
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0666 & ~umask
+
+
+def _update_canonical_hash(h, obj):
+    """Feeds a canonical, type-tagged encoding of `obj` into the hash `h`."""
+    if obj is None or isinstance(obj, (bool, int, long, float)):
+        h.update('%s:%r;' % (type(obj).__name__, obj))
+    elif isinstance(obj, basestring):
+        # str and unicode encode alike, since a CSV reader may produce either
+        data = obj.encode('utf-8') if isinstance(obj, unicode) else obj
+        h.update('s%d:' % len(data))
+        h.update(data)
+    elif isinstance(obj, (list, tuple)):
+        # lists and tuples encode alike, so a list argument and a tuple argument share a key
+        h.update('l%d:' % len(obj))
+        for item in obj:
+            _update_canonical_hash(h, item)
+    elif isinstance(obj, dict):
+        h.update('d%d:' % len(obj))
+        for key_digest, value in sorted(((canonical_hash(key), value) for key, value in obj.items()),
+                                        key=lambda item: item[0]):
+            h.update(key_digest)
+            _update_canonical_hash(h, value)
+    elif isinstance(obj, (set, frozenset)):
+        h.update('e%d:' % len(obj))
+        for item_digest in sorted(canonical_hash(item) for item in obj):
+            h.update(item_digest)
+    elif hasattr(obj, 'tolist'):
+        # pandas Series and numpy arrays and scalars are keyed by their values, independent of
+        # their index, dtype, and the pickle format of the installed version of the library.
+        _update_canonical_hash(h, obj.tolist())
+    else:
+        data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+        h.update('p%d:' % len(data))
+        h.update(data)
+
+
+def canonical_hash(obj):
+    """Returns a hex digest of `obj` that is stable across runs and library versions."""
+    h = hashlib.md5()
+    _update_canonical_hash(h, obj)
+    return h.hexdigest()
+
+
+def canonical_key(*args, **kwargs):
+    """The default key function for `disk_cache`."""
+    return canonical_hash((args, kwargs))
+
+
+def pickle_key(*args, **kwargs):
+    """A key function that pickles the arguments. This is how `disk_cache` used to compute keys."""
+    return hashlib.md5(pickle.dumps((args, kwargs))).hexdigest()
+
+
+def disk_cache(active_fn=lambda: True, cache_dir='./_cache', max_entries=None, max_bytes=None, ttl=None,
+               compress=False, key_fn=canonical_key):
+    """Returns a decorator that caches a function's return values in a `CacheStore` under `cache_dir`.
+
+    `key_fn` is called with the function's arguments, and returns the entry's key: a string
+    that can be used in a file name.
+
+    The decorated function has a `cache` attribute, which is the store."""
     def disk_cache_decorator(fn):
         fn_cache_dir = os.path.join(cache_dir, ''.join(c for c in fn.__name__ if c not in '\0./?'))
-
-        def mk_cache_dirs():
-            for dirname in [cache_dir, fn_cache_dir]:
-                try:
-                    os.mkdir(dirname)
-                except:
-                    pass
+        store = CacheStore(fn_cache_dir, max_entries=max_entries, max_bytes=max_bytes, ttl=ttl,
+                           compress=compress)
 
         def wrapper(*args, **kwargs):
             if not active_fn():
                 return fn(*args, **kwargs)
-            slug = hashlib.md5(pickle.dumps((args, kwargs))).hexdigest()
-            fname = os.path.join(fn_cache_dir, slug + '.pickle')
-            if os.path.exists(fname):
-                with open(fname) as f:
-                    return pickle.load(f)
-            else:
-                mk_cache_dirs()
+            slug = key_fn(*args, **kwargs)
+            found, value = store.get(slug)
+            if not found:
                 value = fn(*args, **kwargs)
-                try:
-                    with open(fname, 'w') as f:
-                        pickle.dump(value, f)
-                    return value
-                except:
-                    try:
-                        os.remove(fname)
-                    except:
-                        pass
-                    raise
+                store.put(slug, value)
+            return value
+        wrapper.cache = store
         return wrapper
     return disk_cache_decorator
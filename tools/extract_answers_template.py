@@ -6,48 +6,79 @@
 """
 
 import argparse
+import cProfile
 import io
 import json
 import os
 import re
 import sys
-import urllib
-from collections import OrderedDict
-from copy import deepcopy
+import time
+from collections import Counter, OrderedDict
 from multiprocessing import Pool
 
-import Levenshtein
+import numpy as np
 import pandas as pd
-import nbformat
-import nbconvert
-from numpy import argmin
 
-from disk_cache import disk_cache
+from answer_clusters import cluster_texts
+from cell_matcher import CellIndex, source_hash
+from disk_cache import CacheStore, canonical_hash, disk_cache
+from http_fetch import HTTPFetcher, RevalidatingCache
+from instrumentation import Instrumentation
+from notebook_html import render_notebook_html
+from semester_index import SemesterIndex
+from summary_bundle import (answer_counts_frame, bundle_path, poll_frame, write_answer_counts_bundle,
+                            write_poll_bundle)
 
 PROJECT_DIR = os.path.relpath(os.path.join(os.path.dirname(__file__), '..'))
 PROCESSED_NOTEBOOK_DIR = os.path.join(PROJECT_DIR, "processed_notebooks")
 SUMMARY_DIR = os.path.join(PROJECT_DIR, 'summaries')
 
 CACHE_DIR = os.path.join(PROJECT_DIR, '_cache')
-use_disk_cache = False  # the --use-disk-cache CLI arg sets this
+# Defaults of the --cache-max-megabytes and --cache-ttl CLI args, for the stores of the --use-disk-cache functions
+DISK_CACHE_MAX_BYTES = 1024 * 2 ** 20
+DISK_CACHE_TTL = 24 * 60 * 60
 
+# Codes in NotebookExtractor.status_matrix. STATUS_NAMES is indexed by the non-negative codes.
+STATUS_NO_NOTEBOOK, STATUS_MISSED, STATUS_BLANK, STATUS_ANSWERED = -1, 0, 1, 2
+STATUS_NAMES = ['missed', 'blank', 'answered']
 
-@disk_cache(active_fn=lambda: use_disk_cache, cache_dir=CACHE_DIR)
+use_disk_cache = False  # the --use-disk-cache CLI arg sets this
+fetch_with_processes = False  # the --fetch-with-processes CLI arg sets this
+http_fetcher = HTTPFetcher()  # the --http-concurrency CLI arg sets its concurrency
+http_cache = None  # the --revalidate-cache CLI arg sets this to a RevalidatingCache
+# HTML of each question's chunk of the summary notebook, keyed by content
+html_chunk_cache = CacheStore(os.path.join(CACHE_DIR, 'html_chunks'), max_bytes=256 * 2 ** 20, compress=True)
+# Stage timings and counters of this run; the --profile CLI arg writes them to a file
+instrumentation = Instrumentation()
+match_profiler = None  # the --cprofile CLI arg sets this to a cProfile.Profile
+
+
+@disk_cache(active_fn=lambda: use_disk_cache, cache_dir=CACHE_DIR, max_bytes=DISK_CACHE_MAX_BYTES,
+            ttl=DISK_CACHE_TTL, compress=True)
 def read_json_from_url(url):
     """Given an URL, return its contents as JSON; or None if no JSON exists at that URL.
 
     Prints exceptions except 404.
 
+    If `http_cache` is set, a previously fetched notebook is revalidated with a conditional request,
+    and returned from the cache if the server responds 304 Not Modified.
+
     This is a global function so that it can be used as an argument to `p.map`"""
 
-    fid = urllib.urlopen(url)
     try:
-        if 200 <= fid.getcode() <= 299:
-            return json.load(fid)
+        cached = http_cache.get(url) if http_cache else None
+        response = http_fetcher.get(url, headers=RevalidatingCache.request_headers(cached))
+        instrumentation.count('http_responses_%d' % response.status)
+        if response.status == 304 and cached:
+            return cached.value
+        if 200 <= response.status <= 299:
+            instrumentation.count('bytes_fetched', len(response.body))
+            value = json.loads(response.body)
+            if http_cache:
+                http_cache.put(url, response, value)
+            return value
     except Exception as ex:
         print >> sys.stderr, "error loading {}: {}".format(url, ex)
-    finally:
-        fid.close()
     return None
 
 
@@ -56,19 +87,99 @@ def p_read_json_from_url(url):
     return read_json_from_url(url)
 
 
+def roster_from_users_df(users_df):
+    """Returns a dictionary {github_username -> full name} from a DataFrame with
+    `gh_username` and `Full Name` columns."""
+    return dict(zip(users_df['gh_username'], users_df['Full Name']))
+
+
+def load_roster(path):
+    """Returns a dictionary {github_username -> full name}.
+
+    `path` is either a JSON file that contains such a dictionary, or a CSV file with a
+    `gh_username` column and either a `Full Name` column or `First Name` and `Last Name` columns."""
+    if os.path.splitext(path)[1].lower() == '.json':
+        with open(path) as f:
+            return json.load(f)
+    df = pd.read_csv(path)
+    if 'Full Name' not in df.columns:
+        df['Full Name'] = df['First Name'].map(str) + ' ' + df['Last Name']
+    return roster_from_users_df(df)
+
+
+def match_prompts(question_prompts, cell_index):
+    """Returns a list with the span `(start, end)` of each prompt's response in the notebook
+    indexed by `cell_index`; or None for prompts that aren't matched.
+
+    The question cells are aligned against the notebook in a single pass, in template order,
+    so that a similar cell elsewhere in the notebook can't capture a question. A question that
+    the alignment leaves out, e.g. one that the student moved, is then matched on its own, to
+    the closest of the cells that no other question was matched to."""
+    aligned_starts = cell_index.align([prompt.start_md for prompt in question_prompts],
+                                      NotebookExtractor.MATCH_THRESH,
+                                      [prompt.start_md_hash for prompt in question_prompts])
+    starts = list(aligned_starts)
+    claimed = {start for start in starts if start is not None}
+    for prompt_idx, prompt in enumerate(question_prompts):
+        if starts[prompt_idx] is None:
+            match = cell_index.find_closest(prompt.start_md, NotebookExtractor.MATCH_THRESH,
+                                            text_hash=prompt.start_md_hash, exclude=claimed)
+            if match is not None:
+                starts[prompt_idx] = match[0]
+                claimed.add(match[0])
+
+    spans = []
+    for prompt_idx, (prompt, start) in enumerate(zip(question_prompts, starts)):
+        if start is None:
+            spans.append(None)
+            continue
+        # A multi-cell response stops at the next question. If the alignment found both questions, it
+        # has already found that cell; else it's searched for after this question.
+        next_prompt = question_prompts[prompt_idx + 1] if prompt_idx + 1 < len(question_prompts) else None
+        stop = None
+        if next_prompt is not None and prompt.stop_md == next_prompt.start_md and start == aligned_starts[prompt_idx]:
+            stop = aligned_starts[prompt_idx + 1]
+        spans.append(prompt.response_span(cell_index, start, NotebookExtractor.MATCH_THRESH, stop))
+    return spans
+
+
+def p_match_notebook(args):
+    """Returns the response spans in a notebook's cells, the `CellIndex` lookup statistics,
+    and the time it took in seconds.
+
+    `args` is a tuple `(question_prompts, cells)`. This is a global function so that it can be used
+    as an argument to `p.map`."""
+    question_prompts, cells = args
+    start_time = time.time()
+    cell_index = CellIndex(cells)
+    spans = match_prompts(question_prompts, cell_index)
+    return spans, cell_index.stats, time.time() - start_time
+
+
 class NotebookExtractor(object):
     """ The top-level class for extracting answers from a notebook.
         TODO: add support multiple notebooks
     """
 
     MATCH_THRESH = 10  # maximum edit distance to consider something a match
+    MATCH_VERSION = 2  # changes when match_prompts can give other spans for the same notebook
 
-    def __init__(self, users_df, notebook_template_file, include_usernames=False):
+    def __init__(self, users_df, notebook_template_file, include_usernames=False, jobs=1, state_store=None,
+                 roster=None):
         """ Initialize with the specified notebook URLs and
-            list of question prompts """
+            list of question prompts.  jobs is the number of
+            processes that match prompts against notebooks.
+            If state_store is a `CacheStore`, the matches from
+            previous runs are kept there, and only new or
+            changed notebooks are matched again.  roster maps
+            github usernames to full names; it defaults to the
+            users_df 'Full Name' column. """
         self.users_df = users_df
+        self.roster = dict(roster) if roster is not None else roster_from_users_df(users_df)
         self.question_prompts = self.build_question_prompts(notebook_template_file)
         self.include_usernames = include_usernames
+        self.jobs = jobs
+        self.state_store = state_store
         nb_basename = os.path.basename(notebook_template_file)
         self.nb_name_stem = os.path.splitext(nb_basename)[0]
 
@@ -103,21 +214,97 @@ class NotebookExtractor(object):
                         prompts[-1].stop_md = u""
                 else:
                     prev_prompt = None
+
+        # Digests of the question cells, for finding unmodified copies without edit distances.
+        for prompt in prompts:
+            prompt.start_md_hash = source_hash(prompt.start_md)
+            prompt.stop_md_hash = source_hash(prompt.stop_md)
         return prompts
 
+    @instrumentation.timed('fetch')
     def fetch_notebooks(self):
         """Returns a dictionary {github_username -> url, json?}.
 
         Unavailable notebooks have a value of `None`."""
 
-        p = Pool(20)  # HTTP fetch parallelism. This number is empirically good.
         print "Fetching %d notebooks..." % self.users_df['notebook_urls'].count()
-        return dict(zip(self.users_df['gh_username'],
-                        p.map(p_read_json_from_url, self.users_df['notebook_urls'])))
+        if fetch_with_processes:
+            # The previous strategy, kept for comparison: a process per concurrent request.
+            p = Pool(20)  # HTTP fetch parallelism. This number is empirically good.
+            notebooks = p.map(p_read_json_from_url, self.users_df['notebook_urls'])
+        else:
+            notebooks = http_fetcher.map(read_json_from_url, self.users_df['notebook_urls'])
+        return dict(zip(self.users_df['gh_username'], notebooks))
 
     def gh_username_to_fullname(self, gh_username):
-        return self.users_df[users_df['gh_username'] == gh_username]['Full Name'].iloc[0]
+        return self.roster.get(gh_username, gh_username)
+
+    @instrumentation.timed('match')
+    def match_notebooks(self, nbs):
+        """Returns a dictionary {github_username -> list of response spans}, for each notebook in `nbs`.
+
+        With `self.jobs > 1`, notebooks are matched in a pool of worker processes."""
+        state = self.load_extraction_state()
+        notebook_hashes = {gh_username: canonical_hash(notebook_content['cells'])
+                           for gh_username, notebook_content in nbs.items() if notebook_content is not None}
+        spans = {gh_username: state[gh_username][1]
+                 for gh_username, notebook_hash in notebook_hashes.items()
+                 if state.get(gh_username, (None,))[0] == notebook_hash}
+
+        usernames = [gh_username for gh_username in notebook_hashes if gh_username not in spans]
+        tasks = [(self.question_prompts, nbs[gh_username]['cells']) for gh_username in usernames]
+        if match_profiler is not None:
+            match_profiler.enable()  # with jobs > 1, this profiles the wait for the workers
+        try:
+            if self.jobs > 1:
+                p = Pool(self.jobs)
+                try:
+                    results = p.map(p_match_notebook, tasks, chunksize=max(1, len(tasks) // (4 * self.jobs)))
+                finally:
+                    p.close()
+                    p.join()
+            else:
+                results = map(p_match_notebook, tasks)
+        finally:
+            if match_profiler is not None:
+                match_profiler.disable()
+        self.match_stats = Counter()
+        for _, stats, seconds in results:
+            self.match_stats.update(stats)
+            instrumentation.sample('match_seconds_per_notebook', seconds)
+        instrumentation.update_counts(self.match_stats, prefix='cell_lookups_')
+        instrumentation.update_counts({'notebooks_matched': len(usernames),
+                                       'notebooks_reused': len(spans)})
+        spans.update((gh_username, notebook_spans) for gh_username, (notebook_spans, _, _) in zip(usernames, results))
+
+        if self.state_store is not None:
+            print "Matched %d new or changed notebooks; reused %d" % (len(usernames), len(spans) - len(usernames))
+            state.update((gh_username, (notebook_hashes[gh_username], spans[gh_username]))
+                         for gh_username in usernames)
+            self.save_extraction_state(state)
+        return spans
 
+    @property
+    def template_hash(self):
+        """A digest of everything besides a notebook's cells that its response spans depend on."""
+        return canonical_hash([NotebookExtractor.MATCH_VERSION, NotebookExtractor.MATCH_THRESH] +
+                              [(prompt.start_md, prompt.stop_md) for prompt in self.question_prompts])
+
+    def load_extraction_state(self):
+        """Returns a dictionary {github_username -> (notebook hash, response spans)} from previous runs
+        with the same template; or an empty dictionary."""
+        if self.state_store is None:
+            return {}
+        found, state = self.state_store.get(self.nb_name_stem)
+        if not found or state['template_hash'] != self.template_hash:
+            return {}
+        return state['notebooks']
+
+    def save_extraction_state(self, notebook_states):
+        self.state_store.put(self.nb_name_stem, {'template_hash': self.template_hash,
+                                                 'notebooks': notebook_states})
+
+    @instrumentation.timed('extract')
     def extract(self):
         """ Filter the notebook at the notebook_URL so that it only contains
             the questions and answers to the reading.
@@ -136,22 +323,28 @@ class NotebookExtractor(object):
             # This makes it easier to find students.
             nbs = OrderedDict(sorted(nbs.items(), key=lambda t: t[0].lower()))
 
-        for prompt in self.question_prompts:
-            prompt.answer_status = {}
+        spans = self.match_notebooks(nbs)
+        print "Question cell lookups: {exact} by exact hash, {fuzzy} by edit distance".format(
+            exact=self.match_stats['exact'], fuzzy=self.match_stats['fuzzy'])
+
+        # status_matrix[prompt index, column of self.usernames] is one of the STATUS_* codes
+        self.status_matrix = np.full((len(self.question_prompts), len(self.usernames)), STATUS_NO_NOTEBOOK,
+                                     dtype=np.int8)
+        username_columns = {gh_username: col for col, gh_username in enumerate(self.usernames)}
+        for prompt_idx, prompt in enumerate(self.question_prompts):
             for gh_username, notebook_content in nbs.items():
                 if notebook_content is None:
                     continue
                 suppress_non_answer = bool(prompt.answers)
-                response_cells = \
-                    prompt.get_closest_match(notebook_content['cells'],
-                                             NotebookExtractor.MATCH_THRESH,
-                                             suppress_non_answer)
+                response_cells = prompt.response_cells(notebook_content['cells'],
+                                                       spans[gh_username][prompt_idx],
+                                                       suppress_non_answer)
                 if not response_cells:
-                    status = 'missed'
+                    status = STATUS_MISSED
                 elif not response_cells[-1]['source'] or not NotebookUtils.cell_list_text(response_cells):
-                    status = 'blank'
+                    status = STATUS_BLANK
                 else:
-                    status = 'answered'
+                    status = STATUS_ANSWERED
                     if not suppress_non_answer:
                         # If it's the first notebook with this answer, extract the questions from it.
                         # This is kind of a bass-ackwards way to do this; it's incremental from the previous
@@ -160,7 +353,7 @@ class NotebookExtractor(object):
                                         if cell['metadata'].get('is_question', False)]
                         response_cells = [cell for cell in response_cells if cell not in prompt.cells]
                     prompt.answers[gh_username] = response_cells
-                prompt.answer_status[gh_username] = status
+                self.status_matrix[prompt_idx, username_columns[gh_username]] = status
 
         sort_responses = not self.include_usernames
         sort_responses = False  # FIXME doesn't work because questions are collected into first response
@@ -170,71 +363,104 @@ class NotebookExtractor(object):
             for prompt in self.question_prompts:
                 prompt.answers = OrderedDict(sorted(prompt.answers.items(), key=lambda t: cell_slines_length(t[1])))
 
+    @instrumentation.timed('report_missing_answers')
     def report_missing_answers(self):
         # Report missing answers
-        mandatory_questions = [prompt for prompt in self.question_prompts
-                               if not prompt.is_poll and not prompt.is_optional]
-        for prompt in mandatory_questions:
-            unanswered = sorted((username, status)
-                                for username, status in prompt.answer_status.items()
-                                if status != 'answered')
-            for username, status in unanswered:
-                print "{status} {prompt_name}: {username}".format(
-                    status=status.capitalize(),
-                    prompt_name=prompt.name,
-                    username=self.gh_username_to_fullname(username))
-
+        mandatory_rows = np.array([not prompt.is_poll and not prompt.is_optional
+                                   for prompt in self.question_prompts], dtype=bool)
+        username_order = np.argsort(self.usernames, kind='mergesort')
+        statuses = self.status_matrix[:, username_order]
+        unanswered = (statuses != STATUS_NO_NOTEBOOK) & (statuses != STATUS_ANSWERED) & mandatory_rows[:, np.newaxis]
+        for prompt_idx, col in zip(*np.nonzero(unanswered)):
+            username = self.usernames[username_order[col]]
+            print "{status} {prompt_name}: {username}".format(
+                status=STATUS_NAMES[statuses[prompt_idx, col]].capitalize(),
+                prompt_name=self.question_prompts[prompt_idx].name,
+                username=self.gh_username_to_fullname(username))
+
+    @instrumentation.timed('write_notebook')
     def write_notebook(self, include_html=True):
         suffix = "_responses_with_names" if self.include_usernames else "_responses"
         nb_name = self.nb_name_stem + suffix
         output_file = os.path.join(PROCESSED_NOTEBOOK_DIR, nb_name + '.ipynb')
         html_output = os.path.join(PROCESSED_NOTEBOOK_DIR, nb_name + '.html')
 
-        remove_duplicate_answers = not self.include_usernames
-
-        filtered_cells = []
-        for prompt in self.question_prompts:
-            filtered_cells += prompt.cells
-            answers = prompt.answers_without_duplicates if remove_duplicate_answers else prompt.answers
-            for gh_username, response_cells in answers.items():
-                if self.include_usernames:
-                    filtered_cells.append(
-                        NotebookUtils.markdown_heading_cell(self.gh_username_to_fullname(gh_username), 4))
-                filtered_cells.extend(response_cells)
-
-        answer_book = deepcopy(self.template)
-        answer_book['cells'] = filtered_cells
-        nb = nbformat.from_dict(answer_book)
+        if include_html:
+            # The HTML renderer needs every cell at once, and converts (copies) each chunk; only the
+            # ipynb-only output is streamed without holding the summary in memory.
+            chunks = [list(self.prompt_output_cells(prompt)) for prompt in self.question_prompts]
+            cells = (cell for chunk in chunks for cell in chunk)
+        else:
+            cells = (cell for prompt in self.question_prompts for cell in self.prompt_output_cells(prompt))
 
         print "Writing", output_file
-        with io.open(output_file, 'wt') as fp:
-            nbformat.write(nb, fp, version=4)
+        with io.open(output_file, 'w', encoding='utf-8') as fp:
+            NotebookUtils.write_ipynb(fp, self.template, cells)
 
         if include_html:
-            # TODO why is the following necessary?
-            nb = nbformat.reads(nbformat.writes(nb, version=4), as_version=4)
-            html_content, _ = nbconvert.export_html(nb)
+            with instrumentation.stage('html'):
+                html_content = render_notebook_html(self.template.get('metadata', {}), chunks,
+                                                    store=html_chunk_cache, processes=self.jobs)
             print "Writing", html_output
-            with io.open(html_output, 'w') as fp:
+            with io.open(html_output, 'w', encoding='utf-8') as fp:
                 fp.write(html_content)
 
+    def prompt_output_cells(self, prompt):
+        """Generates the cells of the summary notebook for one prompt: the question, and the responses."""
+        for cell in prompt.cells:
+            yield cell
+        if not self.include_usernames:
+            for gh_username, response_cells, cluster_size in prompt.answer_clusters():
+                for cell in response_cells:
+                    yield cell
+                if cluster_size > 1:
+                    yield NotebookUtils.markdown_text_cell(u"*({} similar answers)*".format(cluster_size))
+            return
+        for gh_username, response_cells in prompt.answers.items():
+            yield NotebookUtils.markdown_heading_cell(self.gh_username_to_fullname(gh_username), 4)
+            for cell in response_cells:
+                yield cell
+
+    @instrumentation.timed('write_answer_counts')
     def write_answer_counts(self):
         output_file = os.path.join(SUMMARY_DIR, '%s_response_counts.csv' % self.nb_name_stem)
 
-        df = pd.DataFrame(
-            data=[[u in prompt.answers for u in self.usernames] for prompt in self.question_prompts],
-            columns=[self.gh_username_to_fullname(name) for name in self.usernames],
-        )
-        df.index = [prompt.name for prompt in self.question_prompts]
-        df.sort_index(axis=1, inplace=True)
-        df.insert(0, 'Total', df.sum(axis=1))
-        df = pd.concat([df, pd.DataFrame(df.sum(axis=0).astype(int), columns=['Total']).T])
+        questions = [prompt.name for prompt in self.question_prompts]
+        students = [self.gh_username_to_fullname(name) for name in self.usernames]
+        answered = self.status_matrix == STATUS_ANSWERED
+        df = answer_counts_frame(questions, students, answered)
 
         print "Writing", output_file
         print 'Answer counts:'
         print df['Total']
         df.to_csv(output_file)
+        write_answer_counts_bundle(bundle_path(output_file), questions, students, answered)
 
+    @property
+    def assignment_id(self):
+        """The assignment's name in the summaries, e.g. 'day6' for day6_reading_journal.ipynb."""
+        return re.sub(r'_reading_journal$', '', self.nb_name_stem)
+
+    @instrumentation.timed('update_semester_index')
+    def update_semester_index(self, semester_index):
+        """Replaces this assignment's answers in a `SemesterIndex`. Every student in users_df is
+        included; students without a notebook haven't answered any question."""
+        gh_usernames = list(self.users_df['gh_username'])
+        username_columns = {gh_username: col for col, gh_username in enumerate(self.usernames)}
+        # Students who aren't in self.usernames take the all-False column appended to the matrix.
+        answered = np.hstack([self.status_matrix == STATUS_ANSWERED,
+                              np.zeros((len(self.question_prompts), 1), dtype=bool)])
+        answered = answered[:, [username_columns.get(u, -1) for u in gh_usernames]]
+        semester_index.update(
+            self.assignment_id,
+            questions=[prompt.name for prompt in self.question_prompts],
+            mandatory=[not prompt.is_poll and not prompt.is_optional for prompt in self.question_prompts],
+            students=gh_usernames,
+            answered=answered,
+            names=[self.gh_username_to_fullname(name) for name in gh_usernames])
+        print "Updated", semester_index.path
+
+    @instrumentation.timed('write_poll_results')
     def write_poll_results(self):
         poll_questions = [prompt for prompt in self.question_prompts if prompt.is_poll]
         for prompt in poll_questions:
@@ -245,15 +471,11 @@ class NotebookExtractor(object):
             def user_response_text(username):
                 return NotebookUtils.cell_list_text(prompt.answers.get(username, []))
 
-            df = pd.DataFrame(
-                index=[self.gh_username_to_fullname(name) for name in self.usernames],
-                data=[user_response_text(username) for username in self.usernames],
-                columns=['Response'])
-            df.index.name = 'Student'
-            df.sort_index(axis=1, inplace=True)
-            df = df[df['Response'] != '']
+            df = poll_frame([self.gh_username_to_fullname(name) for name in self.usernames],
+                            [user_response_text(username) for username in self.usernames])
 
             df.to_csv(output_file)
+            write_poll_bundle(bundle_path(output_file), df.index, df['Response'])
 
 
 class QuestionPrompt(object):
@@ -276,20 +498,31 @@ class QuestionPrompt(object):
         self.is_optional = is_optional
         self.is_poll = is_poll
         self.index = index
+        self.start_md_hash = None  # set by NotebookExtractor.build_question_prompts
+        self.stop_md_hash = None
         self.answers = OrderedDict()
         self.cells = []
+        self._answer_clusters = None  # (answer usernames, clusters), cached by answer_clusters()
 
     @property
     def answers_without_duplicates(self):
-        answers = dict(self.answers)
-        answer_strings = set()  # answers to this question, as strings; used to avoid duplicates
-        for username, response_cells in self.answers.items():
-            answer_string = '\n'.join(u''.join(cell['source']) for cell in response_cells).strip()
-            if answer_string in answer_strings:
-                del answers[username]
-            else:
-                answer_strings.add(answer_string)
-        return answers
+        return OrderedDict((username, response_cells)
+                           for username, response_cells, _ in self.answer_clusters())
+
+    def answer_clusters(self):
+        """ Returns a list of (username, response_cells, count),
+            with one entry per group of near-duplicate answers.
+            The entry is the group's first answer, and count is
+            the number of answers in the group. """
+        usernames = tuple(self.answers)
+        if self._answer_clusters is None or self._answer_clusters[0] != usernames:
+            answer_strings = ['\n'.join(u''.join(cell['source']) for cell in response_cells).strip()
+                              for response_cells in self.answers.values()]
+            with instrumentation.stage('dedup'):
+                clusters = [(usernames[cluster[0]], self.answers[usernames[cluster[0]]], len(cluster))
+                            for cluster in cluster_texts(answer_strings)]
+            self._answer_clusters = (usernames, clusters)
+        return self._answer_clusters[1]
 
     @property
     def name(self):
@@ -307,33 +540,52 @@ class QuestionPrompt(object):
     def get_closest_match(self,
                           cells,
                           matching_threshold,
-                          suppress_non_answer_cells=False):
+                          suppress_non_answer_cells=False,
+                          cell_index=None):
         """ Returns a list of cells that most closely match
             the question prompt.  If no match is better than
             the matching_threshold, the empty list will be
-            returned. """
-        return_value = []
-        distances = [Levenshtein.distance(self.start_md, u''.join(cell['source']))
-                     for cell in cells]
-        if min(distances) > matching_threshold:
-            return return_value
-
-        best_match = argmin(distances)
+            returned.  Pass a `CellIndex` of `cells` as
+            cell_index to reuse it across prompts. """
+        if cell_index is None:
+            cell_index = CellIndex(cells)
+        match = cell_index.find_closest(self.start_md, matching_threshold, text_hash=self.start_md_hash)
+        if match is None:
+            return []
+        span = self.response_span(cell_index, match[0], matching_threshold)
+        return self.response_cells(cells, span, suppress_non_answer_cells)
+
+    def response_span(self, cell_index, best_match, matching_threshold, stop_match=None):
+        """ Returns the span (start, end) of the cells that respond
+            to the question prompt, given the index of the cell
+            that matches start_md.  stop_match is the index of the
+            cell that matches stop_md, if it is already known.
+            Returns None if stop_md can't be found. """
         if self.stop_md == u"next_cell":
-            end_offset = 2
+            return best_match, best_match + 2
         elif len(self.stop_md) == 0:
-            end_offset = len(cells) - best_match
-        else:
-            distances = [Levenshtein.distance(self.stop_md, u''.join(cell['source']))
-                         for cell in cells[best_match:]]
-            if min(distances) > matching_threshold:
-                return return_value
-            end_offset = argmin(distances)
+            return best_match, len(cell_index)
+        if stop_match is None:
+            match = cell_index.find_closest(self.stop_md, matching_threshold, start=best_match,
+                                            text_hash=self.stop_md_hash)
+            if match is None:
+                return None
+            stop_match = match[0]
+        return best_match, stop_match
+
+    def response_cells(self, cells, span, suppress_non_answer_cells=False):
+        """ Returns the list of cells in span, as returned by
+            response_span. The question cell itself is omitted
+            if suppress_non_answer_cells is true. """
+        return_value = []
+        if span is None:
+            return return_value
+        best_match, end = span
         if len(self.question_heading) != 0 and not suppress_non_answer_cells:
             return_value.append(NotebookUtils.markdown_heading_cell(self.question_heading, 2))
         if not suppress_non_answer_cells:
             return_value.append(cells[best_match])
-        return_value.extend(cells[best_match + 1:best_match + end_offset])
+        return_value.extend(cells[best_match + 1:end])
         return return_value
 
 
@@ -348,6 +600,41 @@ class NotebookUtils:
                 u'metadata': {},
                 u'source': unicode('#' * heading_level + " " + text)}
 
+    @staticmethod
+    def notebook_dict(template, cells):
+        """ Returns a v4 notebook dictionary with the given cells,
+            and the metadata of the template notebook. The
+            template itself is not copied. """
+        return {u'cells': cells,
+                u'metadata': template.get('metadata', {}),
+                u'nbformat': 4,
+                u'nbformat_minor': template.get('nbformat_minor', 0)}
+
+    @staticmethod
+    def write_ipynb(fp, template, cells):
+        """ Writes a v4 notebook with the given cells, and the
+            metadata of the template notebook, to the text file
+            fp. cells can be a generator: each cell is written
+            as soon as it is produced. """
+        def dumps(obj, indent_level):
+            text = json.dumps(obj, indent=1, separators=(',', ': '), sort_keys=True, ensure_ascii=False)
+            return unicode(text).replace(u'\n', u'\n' + u' ' * indent_level)
+
+        nb = NotebookUtils.notebook_dict(template, [])
+        fp.write(u'{\n "cells": [')
+        for idx, cell in enumerate(cells):
+            fp.write(u',\n  ' if idx else u'\n  ')
+            fp.write(dumps(cell, 2))
+        fp.write(u'\n ],\n "metadata": ')
+        fp.write(dumps(nb[u'metadata'], 1))
+        fp.write(u',\n "nbformat": {nbformat},\n "nbformat_minor": {nbformat_minor}\n}}\n'.format(**nb))
+
+    @staticmethod
+    def markdown_text_cell(text):
+        return {u'cell_type': u'markdown',
+                u'metadata': {},
+                u'source': unicode(text)}
+
     @staticmethod
     def cell_list_text(cells):
         return u''.join(s for cell in cells for s in cell['source']).strip()
@@ -355,12 +642,12 @@ class NotebookUtils:
 
 def validate_github_username(gh_name):
     """Return `gh_name` if that Github user has a `repo_name` repository; else None."""
-    fid = urllib.urlopen("http://github.com/" + gh_name)
-    fid.close()
-    return gh_name if 200 <= fid.getcode() <= 299 else None
+    response = http_fetcher.request('HEAD', "https://github.com/" + gh_name)
+    return gh_name if 200 <= response.status <= 299 else None
 
 
-@disk_cache(active_fn=lambda: use_disk_cache, cache_dir=CACHE_DIR)
+@disk_cache(active_fn=lambda: use_disk_cache, cache_dir=CACHE_DIR, max_bytes=DISK_CACHE_MAX_BYTES,
+            ttl=DISK_CACHE_TTL, compress=True)
 def validate_github_usernames(gh_usernames, repo_name):
     """Returns a set of valid github usernames.
 
@@ -369,8 +656,7 @@ def validate_github_usernames(gh_usernames, repo_name):
     `gh_usernames_path` is a path to a CSV file with a `gh_username` column.
 
     Prints invalid names as errors."""
-    p = Pool(20)
-    valid_usernames = filter(None, p.map(validate_github_username, gh_usernames))
+    valid_usernames = filter(None, http_fetcher.map(validate_github_username, gh_usernames))
     invalid_usernames = set(gh_usernames) - set(valid_usernames)
     if invalid_usernames:
         print >> sys.stderr, "Invalid github username(s):", ', '.join(invalid_usernames)
@@ -392,17 +678,55 @@ def get_github_user_notebook_url(gh_username, template_nb_path, repo_name):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Summarize a set of Jupyter notebooks.')
     parser.add_argument('--use-disk-cache', action='store_true')
+    parser.add_argument('--revalidate-cache', action='store_true',
+                        help='cache notebooks, and re-download only those that changed on the server')
+    parser.add_argument('--cache-max-megabytes', type=int, default=DISK_CACHE_MAX_BYTES // 2 ** 20, metavar='MB',
+                        help='size budget of each of the --use-disk-cache and --revalidate-cache stores')
+    parser.add_argument('--cache-ttl', type=float, default=DISK_CACHE_TTL / 3600.0, metavar='HOURS',
+                        help='how long --use-disk-cache entries are used before they are fetched again')
+    parser.add_argument('--http-concurrency', type=int, default=20, metavar='N',
+                        help='number of concurrent HTTP requests')
+    parser.add_argument('--fetch-with-processes', action='store_true',
+                        help='fetch notebooks with a process pool instead of threads, for comparison')
     parser.add_argument('--repo', type=str, default='ReadingJournal', help='Github repository name')
     parser.add_argument('--include-usernames', action='store_true', help='include user names in the summary notebook')
     parser.add_argument('--html-output', action='store_true', help='write an HTML copy of the summary notebook')
+    parser.add_argument('--jobs', type=int, default=1, metavar='N', help='match notebooks in N processes')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only match notebooks that changed since the previous run')
+    parser.add_argument('--roster', type=str, metavar='CSV_OR_JSON_FILE',
+                        help='full names of the github users, if not in GH_USERNAME_CSV_FILE')
+    parser.add_argument('--semester-index', type=str, metavar='FILE',
+                        default=os.path.join(SUMMARY_DIR, 'semester_index.pickle'),
+                        help="semester-wide index of answers, to update with this assignment; '' to not update one")
+    parser.add_argument('--profile', type=str, metavar='JSON_FILE',
+                        help='write the time spent in each stage, and counters such as bytes fetched and cache '
+                             'hits, to JSON_FILE')
+    parser.add_argument('--cprofile', type=str, metavar='STATS_FILE',
+                        help='run cProfile around notebook matching, and write its stats to STATS_FILE '
+                             '(use --jobs 1 to profile the matching itself)')
     parser.add_argument('gh_users', type=str, metavar='GH_USERNAME_CSV_FILE')
     parser.add_argument('template_notebook', type=str, metavar='JUPYTER_NOTEBOOK_FILE')
     args = parser.parse_args()
 
     use_disk_cache = args.use_disk_cache
+    for cached_fn in [read_json_from_url, validate_github_usernames]:
+        cached_fn.cache.max_bytes = args.cache_max_megabytes * 2 ** 20
+        cached_fn.cache.ttl = args.cache_ttl * 3600
+    fetch_with_processes = args.fetch_with_processes
+    if args.revalidate_cache:
+        http_cache = RevalidatingCache(CacheStore(os.path.join(CACHE_DIR, 'http'),
+                                                  max_bytes=args.cache_max_megabytes * 2 ** 20, compress=True))
+    http_fetcher.concurrency = args.http_concurrency
+    if args.cprofile:
+        match_profiler = cProfile.Profile()
     repo_name = args.repo
     users_df = pd.read_csv(args.gh_users)
-    users_df['Full Name'] = users_df['First Name'].map(str) + ' ' + users_df['Last Name']
+    if args.roster:
+        roster = load_roster(args.roster)
+        users_df['Full Name'] = users_df['gh_username'].map(lambda u: roster.get(u, u))
+    else:
+        users_df['Full Name'] = users_df['First Name'].map(str) + ' ' + users_df['Last Name']
 
     valid_github_usernames = validate_github_usernames(users_df['gh_username'], repo_name)
     users_df['valid_github_repo'] = [u in valid_github_usernames for u in users_df['gh_username']]
@@ -410,9 +734,24 @@ if __name__ == '__main__':
     template_nb_path = args.template_notebook
     users_df['notebook_urls'] = [get_github_user_notebook_url(u, template_nb_path, repo_name)
                                  for u in users_df['gh_username']]
-    nbe = NotebookExtractor(users_df, template_nb_path, include_usernames=args.include_usernames)
+    state_store = CacheStore(os.path.join(CACHE_DIR, 'extraction_state')) if args.incremental else None
+    nbe = NotebookExtractor(users_df, template_nb_path, include_usernames=args.include_usernames, jobs=args.jobs,
+                            state_store=state_store)
     nbe.extract()
     nbe.report_missing_answers()
     nbe.write_notebook(include_html=args.html_output)
     nbe.write_poll_results()
     nbe.write_answer_counts()
+    if args.semester_index:
+        nbe.update_semester_index(SemesterIndex.load(args.semester_index))
+
+    if args.cprofile:
+        match_profiler.dump_stats(args.cprofile)
+        print "Wrote", args.cprofile
+    if args.profile:
+        instrumentation.write_report(args.profile, caches={
+            'http': http_cache.store if http_cache else None,
+            'notebooks': read_json_from_url.cache if use_disk_cache else None,
+            'extraction_state': state_store,
+            'html_chunks': html_chunk_cache if args.html_output else None})
+        print "Wrote", args.profile
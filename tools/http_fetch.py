@@ -0,0 +1,148 @@
+""" A small HTTP client for fetching many URLs from a few hosts.
+
+    Each worker thread keeps one keep-alive connection per host, so fetching a
+    class's worth of notebooks from raw.githubusercontent.com reuses a handful of
+    TLS connections instead of opening one per notebook. Requests are retried
+    with exponential backoff, and every request has a timeout.
+
+    A `RevalidatingCache` remembers each URL's `ETag` and `Last-Modified`
+    validators, so that a re-fetch of an unchanged URL is a conditional
+    request answered by an empty 304 response.
+"""
+
+import hashlib
+import httplib
+import socket
+import sys
+import threading
+import time
+import urlparse
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+Response = namedtuple('Response', ['url', 'status', 'headers', 'body'])
+CacheEntry = namedtuple('CacheEntry', ['etag', 'last_modified', 'value'])
+
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+MAX_REDIRECTS = 5
+
+
+class HTTPFetcher(object):
+    """ Fetches URLs over per-thread, per-host keep-alive connections. """
+
+    def __init__(self, concurrency=20, timeout=30, retries=3, backoff=0.5):
+        """ concurrency is the number of threads used by `map`.
+            timeout is in seconds, per request. A failed request
+            is retried up to retries times, waiting backoff,
+            2 * backoff, 4 * backoff, ... seconds in between. """
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._local = threading.local()
+
+    def _connection(self, scheme, netloc):
+        connections = self._local.__dict__.setdefault('connections', {})
+        conn = connections.get((scheme, netloc))
+        if conn is None:
+            conn_class = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+            conn = connections[scheme, netloc] = conn_class(netloc, timeout=self.timeout)
+        return conn
+
+    def _discard_connection(self, scheme, netloc):
+        conn = self._local.__dict__.get('connections', {}).pop((scheme, netloc), None)
+        if conn is not None:
+            conn.close()
+
+    def _request_once(self, method, url, headers):
+        parts = urlparse.urlsplit(url)
+        path = urlparse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+        conn = self._connection(parts.scheme, parts.netloc)
+        try:
+            conn.request(method, path, headers=headers)
+            response = conn.getresponse()
+            body = response.read()
+        except (httplib.HTTPException, socket.error):
+            self._discard_connection(parts.scheme, parts.netloc)
+            raise
+        if response.getheader('connection', '').lower() == 'close':
+            self._discard_connection(parts.scheme, parts.netloc)
+        return Response(url, response.status, dict(response.getheaders()), body)
+
+    def request(self, method, url, headers=None):
+        """Returns a `Response`. Follows redirects, and retries on connection errors and
+        on 429 and 5xx responses. Raises the last error if every attempt fails."""
+        headers = dict(headers or {})
+        for _ in range(MAX_REDIRECTS + 1):
+            response = self._request_with_retries(method, url, headers)
+            if response.status not in REDIRECT_STATUSES or 'location' not in response.headers:
+                return response
+            url = urlparse.urljoin(url, response.headers['location'])
+        return response
+
+    def _request_with_retries(self, method, url, headers):
+        for attempt in range(self.retries + 1):
+            is_last_attempt = attempt == self.retries
+            try:
+                response = self._request_once(method, url, headers)
+            except (httplib.HTTPException, socket.error) as ex:
+                if is_last_attempt:
+                    raise
+                print >> sys.stderr, "retrying {} after error: {}".format(url, ex)
+            else:
+                if response.status not in RETRY_STATUSES or is_last_attempt:
+                    return response
+            time.sleep(self.backoff * 2 ** attempt)
+
+    def get(self, url, headers=None):
+        return self.request('GET', url, headers)
+
+    def close(self):
+        """Closes the calling thread's connections."""
+        for conn in self._local.__dict__.pop('connections', {}).values():
+            conn.close()
+
+    def map(self, fn, items):
+        """Like `Pool.map`, but in `self.concurrency` threads, which share this fetcher's connections."""
+        p = ThreadPool(self.concurrency)
+        try:
+            return p.map(fn, items)
+        finally:
+            p.close()
+            p.join()
+
+
+class RevalidatingCache(object):
+    """ A cache of values derived from HTTP responses, stored with their validators.
+
+        `get` returns the `CacheEntry` for an URL; `request_headers` turns it into the
+        `If-None-Match` / `If-Modified-Since` headers of a conditional request.
+        Entries are kept in a `CacheStore`. """
+
+    def __init__(self, store):
+        self.store = store
+
+    @staticmethod
+    def _key(url):
+        return hashlib.md5(url).hexdigest()
+
+    def get(self, url):
+        _, entry = self.store.get(self._key(url))
+        return entry
+
+    def put(self, url, response, value):
+        """Stores `value`, derived from `response`. Responses without validators aren't stored."""
+        etag = response.headers.get('etag')
+        last_modified = response.headers.get('last-modified')
+        if etag or last_modified:
+            self.store.put(self._key(url), CacheEntry(etag, last_modified, value))
+
+    @staticmethod
+    def request_headers(entry):
+        headers = {}
+        if entry is not None and entry.etag:
+            headers['If-None-Match'] = entry.etag
+        if entry is not None and entry.last_modified:
+            headers['If-Modified-Since'] = entry.last_modified
+        return headers
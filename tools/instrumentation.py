@@ -0,0 +1,113 @@
+""" Timings and counters for the stages of a pipeline run.
+
+    `Instrumentation.stage` times a block of code, in wall-clock and CPU seconds;
+    `timed` is its decorator form.
+    Stages can nest; a nested stage is reported under its dotted path, e.g.
+    `extract.match`, and a stage that runs several times accumulates.
+    `count` adds to a named counter, and `sample` records a value whose
+    distribution is reported as percentiles, e.g. per-notebook latencies.
+
+    Recording is cheap enough to leave on; `report` collects the results into a
+    JSON-serializable dictionary.
+"""
+
+import functools
+import json
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict
+from contextlib import contextmanager
+
+PERCENTILES = [50, 90, 99]
+
+
+def percentile(sorted_values, pct):
+    """Returns the `pct` percentile of a non-empty sorted list, by the nearest-rank method."""
+    rank = max(1, int(-(-pct * len(sorted_values) // 100)))  # ceil(pct / 100 * n)
+    return sorted_values[rank - 1]
+
+
+def summarize_samples(values):
+    values = sorted(values)
+    summary = OrderedDict([('count', len(values))])
+    if values:
+        for pct in PERCENTILES:
+            summary['p%d' % pct] = percentile(values, pct)
+        summary['max'] = values[-1]
+        summary['total'] = sum(values)
+    return summary
+
+
+class Instrumentation(object):
+    """ Stage timings, counters and samples, which may be recorded from several threads.
+
+        Each thread has its own stack of stages, so a stage entered in a worker thread is reported
+        under its own path, not under the stage that the main thread is in. CPU times are those of
+        the whole process. """
+
+    def __init__(self):
+        self.stages = OrderedDict()  # dotted stage path -> {'wall_seconds', 'cpu_seconds', 'calls'}
+        self.counters = Counter()
+        self.samples = defaultdict(list)
+        self._local = threading.local()  # .stage_path: the names of this thread's enclosing stages
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        stage_path = self._local.__dict__.setdefault('stage_path', [])
+        stage_path.append(name)
+        path = '.'.join(stage_path)
+        wall_start = time.time()
+        cpu_start = time.clock()
+        try:
+            yield
+        finally:
+            wall = time.time() - wall_start
+            cpu = time.clock() - cpu_start
+            stage_path.pop()
+            with self._lock:
+                totals = self.stages.setdefault(path, {'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'calls': 0})
+                totals['wall_seconds'] += wall
+                totals['cpu_seconds'] += cpu
+                totals['calls'] += 1
+
+    def timed(self, name):
+        """Returns a decorator that runs the function in the stage `name`."""
+        def timed_decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return timed_decorator
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def update_counts(self, counts, prefix=''):
+        """Adds each of `counts`, a dictionary {name -> count}, to the counter `prefix + name`."""
+        with self._lock:
+            for name, n in counts.items():
+                self.counters[prefix + name] += n
+
+    def sample(self, name, value):
+        with self._lock:
+            self.samples[name].append(value)
+
+    def report(self, caches=None):
+        """Returns a dictionary of the stages, counters and sample summaries.
+
+        `caches` is an optional dictionary {name -> `CacheStore`}, whose stats are included."""
+        report = OrderedDict()
+        report['stages'] = self.stages
+        report['counters'] = OrderedDict(sorted(self.counters.items()))
+        report['samples'] = OrderedDict((name, summarize_samples(values))
+                                        for name, values in sorted(self.samples.items()))
+        report['caches'] = OrderedDict((name, store.stats())
+                                       for name, store in sorted((caches or {}).items()) if store is not None)
+        return report
+
+    def write_report(self, path, caches=None):
+        with open(path, 'w') as f:
+            json.dump(self.report(caches), f, indent=2)
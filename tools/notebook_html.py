@@ -0,0 +1,103 @@
+""" HTML rendering of notebooks, one chunk of cells at a time.
+
+    A processed notebook is split into chunks, one per question. Each chunk is
+    converted with nbconvert's `basic` template, which renders just the cells,
+    and the chunks are placed inside the page frame that the `full` template
+    renders around an empty notebook. Chunks are cached by a hash of their
+    content, so when a few answers change, only their chunks are converted
+    again; and misses are converted in a pool of processes.
+"""
+
+from multiprocessing import Pool
+
+import nbconvert
+import nbformat
+from nbformat.v4.rwbase import rejoin_lines
+
+from disk_cache import canonical_hash
+
+# The full template wraps the notebook's cells in this element.
+NOTEBOOK_CONTAINER_MARKER = 'id="notebook-container">'
+
+
+def notebook_node(metadata, cells):
+    """Returns a NotebookNode with these cells, with multi-line strings as the exporters expect."""
+    return rejoin_lines(nbformat.from_dict({'cells': cells,
+                                            'metadata': metadata,
+                                            'nbformat': 4,
+                                            'nbformat_minor': 0}))
+
+
+def p_render_chunk(args):
+    """Returns the HTML for the cells of a chunk, without the page frame.
+
+    `args` is a tuple `(metadata, cells)`. This is a global function so that it can be used as an
+    argument to `p.map`."""
+    metadata, cells = args
+    exporter = nbconvert.HTMLExporter(template_file='basic')
+    html, _ = exporter.from_notebook_node(notebook_node(metadata, cells))
+    return html
+
+
+def render_page_frame(metadata):
+    """Returns `(head, tail)`: the HTML page that the full template renders for an empty notebook,
+    split where the cells go. Returns None if the template doesn't have the expected container."""
+    html, _ = nbconvert.export_html(notebook_node(metadata, []))
+    split_idx = html.find(NOTEBOOK_CONTAINER_MARKER)
+    if split_idx < 0:
+        return None
+    split_idx += len(NOTEBOOK_CONTAINER_MARKER)
+    return html[:split_idx], html[split_idx:]
+
+
+def split_question_chunks(cells):
+    """Splits a processed notebook's cells into chunks that each start at a question cell.
+
+    Cells before the first question form their own chunk."""
+    chunks = [[]]
+    for cell in cells:
+        if cell['metadata'].get('is_question', False) and chunks[-1]:
+            chunks.append([])
+        chunks[-1].append(cell)
+    return [chunk for chunk in chunks if chunk]
+
+
+def render_notebook_html(metadata, chunks, store=None, processes=1):
+    """Returns the HTML page for a notebook whose cells are the concatenation of `chunks`.
+
+    `store` is an optional `CacheStore` for the HTML of each chunk, and of the page frame.
+    Chunks that aren't in the store are converted in `processes` processes."""
+    def cached(key):
+        return store.get(key) if store is not None else (False, None)
+
+    frame_key = 'frame-' + canonical_hash(metadata)
+    found, frame = cached(frame_key)
+    if not found:
+        frame = render_page_frame(metadata)
+        if store is not None and frame is not None:
+            store.put(frame_key, frame)
+    if frame is None:
+        # Not a template that this module knows how to split; convert the whole notebook at once.
+        html, _resources = nbconvert.export_html(notebook_node(metadata, [cell for chunk in chunks for cell in chunk]))
+        return html
+
+    chunk_keys = ['chunk-' + canonical_hash((metadata, chunk)) for chunk in chunks]
+    chunk_html = [cached(key) for key in chunk_keys]
+    missing = [idx for idx, (chunk_found, _) in enumerate(chunk_html) if not chunk_found]
+    tasks = [(metadata, chunks[idx]) for idx in missing]
+    if processes > 1 and len(tasks) > 1:
+        p = Pool(min(processes, len(tasks)))
+        try:
+            rendered = p.map(p_render_chunk, tasks)
+        finally:
+            p.close()
+            p.join()
+    else:
+        rendered = map(p_render_chunk, tasks)
+    for idx, html in zip(missing, rendered):
+        chunk_html[idx] = (True, html)
+        if store is not None:
+            store.put(chunk_keys[idx], html)
+
+    head, tail = frame
+    return u''.join([head] + [html for _, html in chunk_html] + [tail])
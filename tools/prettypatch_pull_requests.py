@@ -1,13 +1,26 @@
 #!/usr/bin/env python
 
 import argparse
+import json
 import os
 import sys
 import subprocess
+import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
+from Queue import Queue
+
 import github3
 
+from disk_cache import CacheStore
+from http_fetch import HTTPFetcher, RevalidatingCache
+
 PROJECT_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
 BUILD_DIR = os.path.join(PROJECT_DIR, './build')
+CACHE_DIR = os.path.join(PROJECT_DIR, '_cache')
+
+GITHUB_API_URL = 'https://api.github.com'  # the --github-url CLI arg sets this
+MANIFEST_FILENAME = 'manifest.json'
 
 GITHUB_API_TOKEN = os.environ.get('HOMEBREW_GITHUB_API_TOKEN')
 if GITHUB_API_TOKEN:
@@ -16,14 +29,96 @@ else:
     print >> sys.stderr, "Warning: GITHUB_API_TOKEN. Github API calls will be rate-limited."
     gh = github3
 
+http_fetcher = HTTPFetcher()
+# Pull request diffs, stored with their ETags so that re-fetches are conditional requests
+diff_cache = RevalidatingCache(CacheStore(os.path.join(CACHE_DIR, 'pull_request_diffs'), compress=True))
+
+
+class PrettyPatchServer(object):
+    """ A long-lived `PrettyPatch/prettify_server.rb` process, which converts patches to HTML.
+
+        The process reads and writes length-prefixed messages, so that many patches share the
+        cost of starting Ruby and loading PrettyPatch. A server renders one patch at a time. """
+
+    def __init__(self):
+        cmd = os.path.join(PROJECT_DIR, 'PrettyPatch', 'prettify_server.rb')
+        self.process = subprocess.Popen([cmd], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self._lock = threading.Lock()
+
+    def diff2htmls(self, patch_data):
+        """Returns a string: what `prettify.rb` prints for `patch_data`."""
+        with self._lock:
+            self.process.stdin.write('%d\n' % len(patch_data))
+            self.process.stdin.write(patch_data)
+            self.process.stdin.flush()
+            header = self.process.stdout.readline()
+            if not header:
+                raise IOError("prettify_server.rb exited with status %s" % self.process.wait())
+            return self.process.stdout.read(int(header))
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+
+class PrettyPatchServerPool(object):
+    """ `size` PrettyPatch servers, so that concurrent callers can render patches in parallel. """
+
+    def __init__(self, size):
+        self.servers = [PrettyPatchServer() for _ in range(size)]
+        self.idle = Queue()
+        for server in self.servers:
+            self.idle.put(server)
 
-def file_diff2htmls(patch_file):
-    """Returns a string."""
-    cmd = os.path.join(PROJECT_DIR, './PrettyPatch/prettify.rb')
-    return subprocess.check_output(cmd + ' ' + patch_file, shell=True)
+    def diff2htmls(self, patch_data):
+        server = self.idle.get()
+        try:
+            return server.diff2htmls(patch_data)
+        finally:
+            self.idle.put(server)
 
+    def close(self):
+        for server in self.servers:
+            server.close()
 
-def main(user, repo_name):
+
+def fetch_pull_request_diff(user, repo_name, number):
+    """Returns a pull request's diff, and whether it was downloaded (rather than revalidated).
+
+    The request is conditional on the ETag of the previously fetched diff, if any."""
+    url = '{api}/repos/{user}/{repo}/pulls/{number}'.format(api=GITHUB_API_URL.rstrip('/'), user=user,
+                                                            repo=repo_name, number=number)
+    cached = diff_cache.get(url)
+    headers = {'Accept': 'application/vnd.github.v3.diff', 'User-Agent': 'prettypatch_pull_requests'}
+    headers.update(RevalidatingCache.request_headers(cached))
+    if GITHUB_API_TOKEN:
+        headers['Authorization'] = 'token ' + GITHUB_API_TOKEN
+    response = http_fetcher.get(url, headers=headers)
+    if response.status == 304 and cached:
+        return cached.value, False
+    if not 200 <= response.status <= 299:
+        raise IOError("{}: HTTP status {}".format(url, response.status))
+    diff_cache.put(url, response, response.body)
+    return response.body, True
+
+
+def read_manifest(path):
+    """Returns the manifest's dictionary {pull request number -> {'login', 'head_sha', 'updated_at'}}."""
+    try:
+        with open(path) as f:
+            return json.load(f)['pulls']
+    except IOError:
+        return {}
+
+
+def write_manifest(path, pulls):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'pulls': pulls}, f, indent=2, sort_keys=True)
+    os.rename(tmp_path, path)
+
+
+def main(user, repo_name, jobs=4, concurrency=10):
     # do this first, to elicit an error before making directories
     repo = gh.repository(user, repo_name)
 
@@ -31,27 +126,76 @@ def main(user, repo_name):
     repo_build_dir = os.path.join(BUILD_DIR, repo_name)
     patch_dir = os.path.join(repo_build_dir, 'patches')
     html_dir = os.path.join(repo_build_dir, 'html')
-    for dirname in ['build', repo_build_dir, patch_dir, html_dir]:
+    for dirname in [BUILD_DIR, repo_build_dir, patch_dir, html_dir]:
         if not os.path.isdir(dirname):
             os.mkdir(dirname)
 
-    for pr in repo.iter_pulls():
-        print pr.user.login
+    def output_files(pr):
+        return (os.path.join(patch_dir, pr.user.login + '.patch'),
+                os.path.join(html_dir, pr.user.login + '-patch.html'))
+
+    def manifest_entry(pr):
+        return {'login': pr.user.login,
+                'head_sha': pr.head.sha,
+                'updated_at': pr.updated_at.isoformat() if pr.updated_at else None}
 
-        patch_file = os.path.join(patch_dir, pr.user.login + '.patch')
+    # The manifest records the head and update time of each pull request as of its last snapshot.
+    # Pull requests that haven't changed since, and whose files are still there, are skipped.
+    manifest_path = os.path.join(repo_build_dir, MANIFEST_FILENAME)
+    manifest = read_manifest(manifest_path)
+    pulls = list(repo.iter_pulls())
+    changed_pulls = [pr for pr in pulls
+                     if manifest.get(str(pr.number)) != manifest_entry(pr)
+                     or not all(os.path.exists(path) for path in output_files(pr))]
+    print "{} of {} pull requests changed".format(len(changed_pulls), len(pulls))
+    if not changed_pulls:
+        return
+
+    renderer = PrettyPatchServerPool(min(jobs, len(changed_pulls)))
+    manifest_lock = threading.Lock()
+    download_count = [0]
+
+    def write_pull_request(pr):
+        """Writes a pull request's patch and HTML files. Runs in a `ThreadPool` worker."""
+        patch_data, downloaded = fetch_pull_request_diff(user, repo_name, pr.number)
+        patch_file, html_file = output_files(pr)
         with open(patch_file, 'w') as f:
-            print >> f, pr.diff()
+            print >> f, patch_data
 
-        html_file = os.path.join(html_dir, pr.user.login + '-patch.html')
-        html_diff = file_diff2htmls(patch_file)
+        html_diff = renderer.diff2htmls(patch_data + '\n')  # what prettify.rb read from the patch file
         with open(html_file, 'w') as f:
             print >> f, pr.body_html.encode('utf8')
             print >> f, html_diff
+        with manifest_lock:
+            manifest[str(pr.number)] = manifest_entry(pr)
+            download_count[0] += downloaded
+        return pr.user.login
+
+    # Pull requests are fetched and rendered concurrently; the diff downloads overlap the rendering.
+    p = ThreadPool(max(jobs, concurrency))
+    try:
+        for login in p.imap_unordered(write_pull_request, changed_pulls):
+            print login
+    finally:
+        p.close()
+        p.join()
+        renderer.close()
+        write_manifest(manifest_path, manifest)
+    print "Downloaded {} diffs; {} were unchanged on the server".format(
+        download_count[0], len(changed_pulls) - download_count[0])
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Create *.patch and *-patch.html for pull requests.')
+    parser.add_argument('--jobs', type=int, default=4, metavar='N', help='number of PrettyPatch processes')
+    parser.add_argument('--concurrency', type=int, default=10, metavar='N',
+                        help='number of pull requests to fetch at the same time')
+    parser.add_argument('--github-url', type=str, metavar='URL',
+                        help='base URL of a GitHub Enterprise (or test) server, whose API is at URL/api/v3')
     parser.add_argument('user', type=str, metavar='GITHUB_USER')
     parser.add_argument('repo', type=str, metavar='GITHUB_REPO')
     args = parser.parse_args()
-    main(args.user, args.repo)
+    if args.github_url:
+        gh = github3.GitHubEnterprise(args.github_url, token=GITHUB_API_TOKEN or '')
+        GITHUB_API_URL = args.github_url.rstrip('/') + '/api/v3'
+    main(args.user, args.repo, jobs=args.jobs, concurrency=args.concurrency)
@@ -0,0 +1,149 @@
+""" An aggregate of the answer counts of every assignment in the semester.
+
+    The index holds one block per assignment: its questions, which of them are
+    mandatory, its students' github usernames and full names, and a question x
+    student matrix of answered flags. Students are keyed by github username, since
+    two students can have the same name.
+    Updating an assignment replaces its block and recomputes the student x
+    (assignment, question) matrix and its totals, which are saved with the blocks,
+    so that readers don't reparse any summaries.
+"""
+
+import os
+import pickle
+import re
+import sys
+import tempfile
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+from disk_cache import default_file_mode
+
+ANSWERED = 1
+UNANSWERED = 0
+NOT_ENROLLED = -1  # the student wasn't in the assignment's roster
+
+
+def natural_sort_key(s):
+    int_re = re.compile(r'(-?\d+)')
+    return tuple(int(c) if int_re.match(c) else c
+                 for c in int_re.split(s))
+
+
+class SemesterIndex(object):
+    """ The student x (assignment, question) answer matrix for the semester, stored at `path`. """
+
+    def __init__(self, path):
+        self.path = path
+        self.blocks = {}
+        self.mtime = None
+        self._recompute()
+
+    @classmethod
+    def load(cls, path):
+        """Returns the index stored at `path`; or an empty index if there is none yet."""
+        index = cls(path)
+        index.reload()
+        return index
+
+    def reload(self):
+        """Reads the index again if its file has changed. Returns True if it was read.
+
+        If the file can't be read, e.g. by another user, the index keeps its current contents."""
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return False
+        if mtime == self.mtime:
+            return False
+        try:
+            with open(self.path, 'rb') as f:
+                state = pickle.load(f)
+        except (IOError, KeyError, ValueError, EOFError, pickle.UnpicklingError) as e:
+            print >> sys.stderr, "Can't read the semester index {}: {}".format(self.path, e)
+            return False
+        self.__dict__.update(state)
+        self.mtime = mtime
+        return True
+
+    def save(self):
+        state = {k: v for k, v in self.__dict__.items() if k not in ('path', 'mtime')}
+        dirname = os.path.dirname(self.path) or '.'
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+        os.chmod(tmp_path, default_file_mode())  # mkstemp's 0600 would hide the index from the web app's user
+        os.rename(tmp_path, self.path)
+        self.mtime = os.path.getmtime(self.path)
+
+    def update(self, assignment_id, questions, mandatory, students, answered, names=None):
+        """Replaces the block for `assignment_id`, and saves the index.
+
+        `students` are github usernames, and `names` their full names, for display.
+        `answered` is a boolean matrix with a row per question and a column per student;
+        `mandatory` has a flag per question."""
+        self.reload()
+        self.blocks[assignment_id] = {
+            'questions': list(questions),
+            'mandatory': np.asarray(mandatory, dtype=bool),
+            'students': list(students),
+            'names': list(names) if names is not None else list(students),
+            'answered': np.asarray(answered, dtype=bool).reshape(len(questions), len(students)),
+        }
+        self._recompute()
+        self.save()
+
+    def _recompute(self):
+        self.assignment_ids = sorted(self.blocks, key=natural_sort_key)
+        names = {}
+        for assignment_id in self.assignment_ids:  # later assignments have the more recent names
+            block = self.blocks[assignment_id]
+            names.update(zip(block['students'], block.get('names', block['students'])))
+        self.students = sorted(names, key=lambda student: (names[student], student))
+        # Full names for display; a name shared by several students is qualified by the username.
+        name_counts = Counter(names.values())
+        self.student_names = [names[student] if name_counts[names[student]] == 1
+                              else '%s (%s)' % (names[student], student)
+                              for student in self.students]
+        student_rows = {student: row for row, student in enumerate(self.students)}
+        self.columns = [(assignment_id, question)
+                        for assignment_id in self.assignment_ids
+                        for question in self.blocks[assignment_id]['questions']]
+        self.matrix = np.full((len(self.students), len(self.columns)), NOT_ENROLLED, dtype=np.int8)
+        self.mandatory = np.zeros(len(self.columns), dtype=bool)
+        self.column_assignments = np.zeros(len(self.columns), dtype=int)  # column -> position in assignment_ids
+
+        col = 0
+        for assignment_pos, assignment_id in enumerate(self.assignment_ids):
+            block = self.blocks[assignment_id]
+            ncols = len(block['questions'])
+            rows = [student_rows[student] for student in block['students']]
+            if rows and ncols:
+                self.matrix[np.ix_(rows, list(range(col, col + ncols)))] = block['answered'].T
+            self.mandatory[col:col + ncols] = block['mandatory']
+            self.column_assignments[col:col + ncols] = assignment_pos
+            col += ncols
+
+        answered = self.matrix == ANSWERED
+        missed = (self.matrix == UNANSWERED) & self.mandatory
+        self.student_answered = answered.sum(axis=1)
+        self.student_missed = missed.sum(axis=1)
+        # student x assignment counts of missed mandatory questions
+        self.student_assignment_missed = np.zeros((len(self.students), len(self.assignment_ids)), dtype=int)
+        self.assignment_answered = np.zeros(len(self.assignment_ids), dtype=int)
+        for assignment_pos in range(len(self.assignment_ids)):
+            columns = self.column_assignments == assignment_pos
+            self.student_assignment_missed[:, assignment_pos] = missed[:, columns].sum(axis=1)
+            self.assignment_answered[assignment_pos] = answered[:, columns].sum()
+        self.assignment_missed = self.student_assignment_missed.sum(axis=0)
+
+    def student_summary(self, min_missed=0):
+        """Returns a DataFrame with a row per student who missed at least `min_missed` mandatory
+        questions: the number missed in each assignment, and the semester totals."""
+        df = pd.DataFrame(self.student_assignment_missed, index=self.student_names, columns=self.assignment_ids)
+        df.index.name = 'Student'
+        df.insert(0, 'Total answered', self.student_answered)
+        df.insert(0, 'Total missed', self.student_missed)
+        return df[df['Total missed'] >= min_missed]
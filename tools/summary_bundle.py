@@ -0,0 +1,128 @@
+""" A compact binary format for the assignment summaries, alongside the CSV files.
+
+    A bundle is an uncompressed numpy `.npz` archive with a `kind` entry. Its
+    names and texts are stored as one byte array of their concatenated UTF-8
+    encodings, and an array of their end offsets; a fixed-width unicode array
+    would pad every text to the longest one, at 4 bytes per character.
+    The answer-count matrix is stored as a packed bit matrix, one bit per
+    (question, student). Reading a bundle needs no text parsing, and builds the
+    same DataFrame as the extractor writes to CSV.
+"""
+
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from disk_cache import default_file_mode
+
+BUNDLE_VERSION = 2
+BUNDLE_EXTENSION = '.npz'
+
+
+def _text_arrays(*columns):
+    """Returns the arrays `texts` and `text_offsets` that store the strings of `columns`, in order."""
+    encoded = [value if isinstance(value, str) else unicode(value).encode('utf-8')
+               for column in columns for value in column]
+    return {'texts': np.frombuffer(''.join(encoded), dtype=np.uint8),
+            'text_offsets': np.cumsum([len(value) for value in encoded], dtype=np.int64)}
+
+
+def _read_texts(bundle):
+    """Returns the list of unicode strings stored by `_text_arrays`."""
+    data = bundle['texts'].tobytes()
+    ends = bundle['text_offsets'].tolist()
+    return [data[start:end].decode('utf-8') for start, end in zip([0] + ends[:-1], ends)]
+
+
+def bundle_path(csv_path):
+    """Returns the path of the bundle that accompanies a summary CSV file."""
+    return csv_path[:-len('.csv')] + BUNDLE_EXTENSION if csv_path.endswith('.csv') else csv_path + BUNDLE_EXTENSION
+
+
+def answer_counts_frame(questions, students, answered):
+    """Returns the response-counts DataFrame: one row per question and one column per student, in
+    student order, with a `Total` column first and a `Total` row last.
+
+    `answered` is a boolean matrix with a row per question and a column per student."""
+    answered = np.asarray(answered, dtype=bool).reshape(len(questions), len(students))
+    order = np.argsort(np.array(students, dtype=object), kind='mergesort')
+    answered = answered[:, order]
+    question_totals = answered.sum(axis=1)
+    student_totals = answered.sum(axis=0)
+
+    # The flags and the totals are filled into one int matrix, so the frame is built without copies.
+    data = np.empty((len(questions) + 1, len(students) + 1), dtype=int)
+    data[:-1, 0] = question_totals
+    data[:-1, 1:] = answered
+    data[-1, 0] = question_totals.sum()
+    data[-1, 1:] = student_totals
+    return pd.DataFrame(data,
+                        index=list(questions) + ['Total'],
+                        columns=['Total'] + [students[idx] for idx in order])
+
+
+def poll_frame(students, responses):
+    """Returns a poll's DataFrame, indexed by student, without the students who didn't respond."""
+    df = pd.DataFrame(index=students, data=list(responses), columns=['Response'])
+    df.index.name = 'Student'
+    return df[df['Response'] != '']
+
+
+def _write_bundle(path, **arrays):
+    """Writes the archive to a temporary file that is renamed into place, so that a reader
+    (e.g. the web app) never loads a partially written bundle."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.chmod(tmp_path, default_file_mode())
+        os.rename(tmp_path, path)
+    except:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def write_answer_counts_bundle(path, questions, students, answered):
+    answered = np.asarray(answered, dtype=bool).reshape(len(questions), len(students))
+    _write_bundle(path,
+                  kind=np.array('response_counts'),
+                  version=np.array(BUNDLE_VERSION),
+                  shape=np.array(answered.shape),
+                  answered_bits=np.packbits(answered, axis=None),
+                  **_text_arrays(questions, students))
+
+
+def write_poll_bundle(path, students, responses):
+    """Writes a poll's rows, which are those of `poll_frame`: only the students who responded."""
+    _write_bundle(path,
+                  kind=np.array('poll'),
+                  version=np.array(BUNDLE_VERSION),
+                  **_text_arrays(students, responses))
+
+
+def read_summary_bundle(path):
+    """Returns the summary DataFrame stored in the bundle at `path`.
+
+    Raises ValueError if the bundle was written by another version of this module."""
+    with np.load(path) as bundle:
+        version = bundle['version'].item() if 'version' in bundle.files else None
+        if version != BUNDLE_VERSION:
+            raise ValueError("{}: unsupported bundle version {!r}".format(path, version))
+        kind = bundle['kind'].item()
+        if kind == 'response_counts':
+            rows, cols = bundle['shape']
+            answered = np.unpackbits(bundle['answered_bits'])[:rows * cols].astype(bool).reshape(rows, cols)
+            texts = _read_texts(bundle)
+            return answer_counts_frame(texts[:rows], texts[rows:], answered)
+        elif kind == 'poll':
+            texts = _read_texts(bundle)
+            # The rows were filtered by `poll_frame` before they were written.
+            df = pd.DataFrame(index=texts[:len(texts) // 2], data=texts[len(texts) // 2:], columns=['Response'])
+            df.index.name = 'Student'
+            return df
+        raise ValueError("{}: unknown summary kind {!r}".format(path, kind))
@@ -0,0 +1,51 @@
+import random
+import unittest
+
+from answer_clusters import cluster_texts
+
+VOCABULARY = ['%s%s' % (stem, suffix) for stem in ['read', 'chapter', 'loop', 'list', 'string', 'function', 'value',
+                                                   'class', 'method', 'example', 'python', 'answer', 'think']
+              for suffix in ['', 's', 'ed', 'ing']]
+
+
+class AnswerClustersTest(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(0)
+
+    def random_answer(self, n_words):
+        return ' '.join(self.rng.choice(VOCABULARY) for _ in range(n_words))
+
+    def assertClustered(self, a, b):
+        self.assertEqual(cluster_texts([a, b]), [[0, 1]], "not clustered:\n%s\n%s" % (a, b))
+
+    def test_exact_duplicates_after_normalization(self):
+        self.assertEqual(cluster_texts([u'A list is mutable', u'  a LIST\nis mutable ', u'a tuple is not']),
+                         [[0, 1], [2]])
+
+    def test_punctuation_differences(self):
+        for n_words in [1, 5, 15, 40]:
+            answer = self.random_answer(n_words)
+            self.assertClustered(answer, answer + '.')
+            self.assertClustered(answer, answer.capitalize().replace(' ', ', ', 1) + '!')
+
+    def test_one_word_edits(self):
+        for n_words in [15, 40, 100]:
+            for _ in range(50):
+                words = self.random_answer(n_words).split()
+                edited = list(words)
+                idx = self.rng.randrange(n_words)
+                edited[idx] = self.rng.choice([word for word in VOCABULARY if word != words[idx]])
+                self.assertClustered(' '.join(words), ' '.join(edited))
+
+    def test_unrelated_answers(self):
+        for n_words in [5, 15, 40, 100]:
+            texts = [self.random_answer(n_words) for _ in range(50)]
+            self.assertEqual(cluster_texts(texts), [[idx] for idx in range(len(texts))])
+
+    def test_clusters_are_ordered(self):
+        a, b = self.random_answer(20), self.random_answer(20)
+        self.assertEqual(cluster_texts([a, b, a + '.', '', b, '']), [[0, 2], [1, 4], [3, 5]])
+
+
+if __name__ == '__main__':
+    unittest.main()
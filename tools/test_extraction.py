@@ -0,0 +1,189 @@
+""" Tests of the fetch and match layers of extract_answers_template.py.
+
+    The fetch tests run against a local HTTP stand-in for raw.githubusercontent.com
+    that serves fixture notebooks. The matcher tests compare `bounded_distance`
+    and `CellIndex.find_closest` with a reference edit distance.
+"""
+
+import BaseHTTPServer
+import json
+import random
+import shutil
+import SocketServer
+import tempfile
+import threading
+import unittest
+
+from cell_matcher import CellIndex, bounded_distance
+from disk_cache import CacheStore
+from http_fetch import HTTPFetcher, RevalidatingCache
+
+FIXTURE_NOTEBOOKS = {'/student%d/ReadingJournal/master/day1_reading_journal.ipynb' % idx:
+                     json.dumps({'cells': [{'cell_type': 'markdown', 'metadata': {}, 'source': ['answer %d' % idx]}]})
+                     for idx in range(20)}
+
+
+class FixtureRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Serves the server's `documents` with ETags, as raw.githubusercontent.com does. A path
+        in the server's `failures` is answered with 503 Service Unavailable that many times. """
+    protocol_version = 'HTTP/1.1'  # keep-alive
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.client_address, self.path, self.headers.get('if-none-match')))
+            failures = server.failures.get(self.path, 0)
+            if failures:
+                server.failures[self.path] = failures - 1
+        body = server.documents.get(self.path)
+        etag = '"%d"' % hash(body)
+        if failures:
+            status, body = 503, 'Service Unavailable'
+        elif body is None:
+            status, body = 404, 'Not Found'
+        elif self.headers.get('if-none-match') == etag:
+            status, body = 304, ''
+        else:
+            status = 200
+        self.send_response(status)
+        if status in (200, 304):
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FixtureServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, documents):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), FixtureRequestHandler)
+        self.documents = documents
+        self.failures = {}  # path -> number of 503 responses to send before serving it
+        self.requests = []  # (client address, path, If-None-Match header)
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self.server_port, path)
+
+
+class HTTPFetcherTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = FixtureServer(FIXTURE_NOTEBOOKS)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.failures.clear()
+        del self.server.requests[:]
+        self.fetcher = HTTPFetcher(concurrency=4, timeout=5, retries=2, backoff=0)
+        self.addCleanup(self.fetcher.close)
+
+    def test_connections_are_reused(self):
+        paths = sorted(FIXTURE_NOTEBOOKS) * 3
+        responses = self.fetcher.map(lambda path: self.fetcher.get(self.server.url(path)), paths)
+        self.assertEqual([response.status for response in responses], [200] * len(paths))
+        self.assertEqual([response.body for response in responses], [FIXTURE_NOTEBOOKS[path] for path in paths])
+        client_addresses = {client_address for client_address, _, _ in self.server.requests}
+        self.assertLessEqual(len(client_addresses), self.fetcher.concurrency)
+
+    def test_retries_on_503(self):
+        path = sorted(FIXTURE_NOTEBOOKS)[0]
+        self.server.failures[path] = 2
+        response = self.fetcher.get(self.server.url(path))
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.body, FIXTURE_NOTEBOOKS[path])
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_gives_up_after_retries(self):
+        path = sorted(FIXTURE_NOTEBOOKS)[0]
+        self.server.failures[path] = self.fetcher.retries + 1
+        self.assertEqual(self.fetcher.get(self.server.url(path)).status, 503)
+        self.assertEqual(len(self.server.requests), self.fetcher.retries + 1)
+
+    def test_not_found(self):
+        self.assertEqual(self.fetcher.get(self.server.url('/nobody/ReadingJournal/master/x.ipynb')).status, 404)
+
+    def test_revalidation(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        cache = RevalidatingCache(CacheStore(cache_dir))
+        url = self.server.url(sorted(FIXTURE_NOTEBOOKS)[0])
+
+        response = self.fetcher.get(url, headers=RevalidatingCache.request_headers(cache.get(url)))
+        self.assertEqual(response.status, 200)
+        cache.put(url, response, json.loads(response.body))
+
+        entry = cache.get(url)
+        response = self.fetcher.get(url, headers=RevalidatingCache.request_headers(entry))
+        self.assertEqual(response.status, 304)
+        self.assertEqual(response.body, '')
+        self.assertEqual(entry.value, json.loads(FIXTURE_NOTEBOOKS[sorted(FIXTURE_NOTEBOOKS)[0]]))
+        self.assertEqual(self.server.requests[-1][2], entry.etag)
+
+
+def edit_distance(s1, s2):
+    """The Levenshtein distance, by the textbook dynamic program."""
+    row = range(len(s2) + 1)
+    for i, c1 in enumerate(s1, 1):
+        prev_row, row = row, [i]
+        for j, c2 in enumerate(s2, 1):
+            row.append(min(prev_row[j] + 1, row[j - 1] + 1, prev_row[j - 1] + (c1 != c2)))
+    return row[-1]
+
+
+class CellMatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(0)
+
+    def random_text(self, alphabet=u'ab #\n', max_length=12):
+        return u''.join(self.rng.choice(alphabet) for _ in range(self.rng.randrange(max_length + 1)))
+
+    def edited(self, text, edits):
+        chars = list(text)
+        for _ in range(edits):
+            pos = self.rng.randrange(len(chars) + 1)
+            if pos < len(chars) and self.rng.random() < 0.5:
+                del chars[pos]
+            else:
+                chars.insert(pos, self.rng.choice(u'ab #\n'))
+        return u''.join(chars)
+
+    def test_bounded_distance(self):
+        for _ in range(3000):
+            s1, s2 = self.random_text(), self.random_text()
+            max_distance = self.rng.randrange(8)
+            distance = edit_distance(s1, s2)
+            self.assertEqual(bounded_distance(s1, s2, max_distance), distance if distance <= max_distance else None,
+                             (s1, s2, max_distance))
+
+    def test_find_closest(self):
+        for _ in range(500):
+            template = self.random_text(max_length=30)
+            sources = [self.edited(template, self.rng.randrange(6)) if self.rng.random() < 0.5 else self.random_text()
+                       for _ in range(self.rng.randrange(1, 12))]
+            cell_index = CellIndex([{'source': source.splitlines(True)} for source in sources])
+            max_distance = self.rng.randrange(1, 8)
+            start = self.rng.randrange(len(sources))
+            exclude = {idx for idx in range(len(sources)) if self.rng.random() < 0.2}
+            distances = [(edit_distance(template, source), idx) for idx, source in enumerate(sources)
+                         if idx >= start and idx not in exclude]
+            distance, idx = min(distances) if distances else (None, None)
+            expected = (idx, distance) if distance is not None and distance <= max_distance else None
+            self.assertEqual(cell_index.find_closest(template, max_distance, start=start, exclude=exclude), expected,
+                             (template, sources, max_distance, start, exclude))
+
+
+if __name__ == '__main__':
+    unittest.main()
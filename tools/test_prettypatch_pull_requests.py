@@ -0,0 +1,171 @@
+""" Tests that re-runs of prettypatch_pull_requests.py only download the diffs that changed.
+
+    The pull requests are served by a local fake of the GitHub API, which counts the
+    diffs it sends, and the patches are rendered by a stand-in for PrettyPatch, so that
+    the tests don't need Ruby.
+"""
+
+import BaseHTTPServer
+import json
+import os
+import shutil
+import SocketServer
+import sys
+import tempfile
+import threading
+import unittest
+import urlparse
+from StringIO import StringIO
+
+import github3
+
+import prettypatch_pull_requests
+from disk_cache import CacheStore
+from http_fetch import RevalidatingCache
+
+
+class FakeGitHubRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Serves the repository `user/repo` and its pull requests, from the server's `pulls`,
+        a dictionary {number -> {'login', 'head_sha', 'updated_at', 'diff'}}. Diffs have ETags. """
+    protocol_version = 'HTTP/1.1'
+
+    def send(self, status, body, content_type='application/json', headers={}):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def pull_json(self, api_url, number, pull):
+        user_url = api_url + '/users/' + pull['login']
+        return {'id': number, 'number': number, 'state': 'open', 'title': 'Reading journal',
+                'url': '%s/repos/user/repo/pulls/%d' % (api_url, number),
+                'html_url': 'https://github.com/user/repo/pull/%d' % number,
+                'diff_url': 'https://github.com/user/repo/pull/%d.diff' % number,
+                'patch_url': 'https://github.com/user/repo/pull/%d.patch' % number,
+                'issue_url': '%s/repos/user/repo/issues/%d' % (api_url, number),
+                'head': {'sha': pull['head_sha'], 'ref': 'master', 'label': pull['login'] + ':master'},
+                'base': {'sha': 'base', 'ref': 'master', 'label': 'user:master'},
+                'user': {'id': number, 'login': pull['login'], 'url': user_url},
+                'body_html': '<p>%s</p>' % pull['login'],
+                'created_at': pull['updated_at'], 'updated_at': pull['updated_at']}
+
+    def do_GET(self):
+        server = self.server
+        path = urlparse.urlsplit(self.path).path
+        api_url = 'http://127.0.0.1:%d/api/v3' % server.server_port
+        if path == '/api/v3/repos/user/repo':
+            return self.send(200, json.dumps({'id': 1, 'name': 'repo', 'full_name': 'user/repo',
+                                              'url': api_url + '/repos/user/repo',
+                                              'owner': {'id': 1, 'login': 'user', 'url': api_url + '/users/user'}}))
+        if path == '/api/v3/repos/user/repo/pulls':
+            return self.send(200, json.dumps([self.pull_json(api_url, number, pull)
+                                              for number, pull in sorted(server.pulls.items())]))
+        for number, pull in server.pulls.items():
+            if path == '/api/v3/repos/user/repo/pulls/%d' % number:
+                etag = '"%s"' % pull['head_sha']
+                with server.lock:
+                    if self.headers.get('if-none-match') == etag:
+                        server.diffs_revalidated += 1
+                        return self.send(304, '', headers={'ETag': etag})
+                    server.diffs_downloaded += 1
+                return self.send(200, pull['diff'], 'text/plain', {'ETag': etag})
+        self.send(404, json.dumps({'message': 'Not Found'}))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeGitHubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, pulls):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), FakeGitHubRequestHandler)
+        self.pulls = pulls
+        self.diffs_downloaded = 0
+        self.diffs_revalidated = 0
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_port
+
+
+class FakeRendererPool(object):
+    """ Stands in for `PrettyPatchServerPool`. """
+
+    def __init__(self, size):
+        pass
+
+    def diff2htmls(self, patch_data):
+        return '<pre>%s</pre>' % patch_data
+
+    def close(self):
+        pass
+
+
+def pull_request(idx, head_sha='a', updated_at='2016-02-01T12:00:00Z'):
+    login = 'student%d' % idx
+    diff = ('diff --git a/day1_reading_journal.ipynb b/day1_reading_journal.ipynb\n'
+            '--- a/day1_reading_journal.ipynb\n+++ b/day1_reading_journal.ipynb\n'
+            '@@ -1 +1 @@\n-question\n+answer by %s at %s\n' % (login, head_sha))
+    return {'login': login, 'head_sha': head_sha, 'updated_at': updated_at, 'diff': diff}
+
+
+class PrettyPatchPullRequestsTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeGitHubServer({number: pull_request(number) for number in range(1, 31)})
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+        module = prettypatch_pull_requests
+        saved = {name: getattr(module, name)
+                 for name in ['BUILD_DIR', 'GITHUB_API_URL', 'gh', 'diff_cache', 'PrettyPatchServerPool']}
+        self.addCleanup(lambda: [setattr(module, name, value) for name, value in saved.items()])
+        module.BUILD_DIR = os.path.join(self.tmp_dir, 'build')
+        module.GITHUB_API_URL = self.server.url + '/api/v3'
+        module.gh = github3.GitHubEnterprise(self.server.url)
+        module.diff_cache = RevalidatingCache(CacheStore(os.path.join(self.tmp_dir, 'cache')))
+        module.PrettyPatchServerPool = FakeRendererPool
+        self.repo_build_dir = os.path.join(module.BUILD_DIR, 'repo')
+
+    def run_main(self):
+        """Runs the command, and returns the number of diffs that the server sent and revalidated."""
+        downloaded, revalidated = self.server.diffs_downloaded, self.server.diffs_revalidated
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            prettypatch_pull_requests.main('user', 'repo')
+        finally:
+            sys.stdout = stdout
+        return self.server.diffs_downloaded - downloaded, self.server.diffs_revalidated - revalidated
+
+    def test_rerun_downloads_no_diffs(self):
+        self.assertEqual(self.run_main(), (30, 0))
+        for pull in self.server.pulls.values():
+            with open(os.path.join(self.repo_build_dir, 'patches', pull['login'] + '.patch')) as f:
+                self.assertEqual(f.read(), pull['diff'] + '\n')
+            self.assertTrue(os.path.exists(os.path.join(self.repo_build_dir, 'html', pull['login'] + '-patch.html')))
+        self.assertEqual(self.run_main(), (0, 0))
+
+    def test_changed_pull_requests(self):
+        self.run_main()
+        self.server.pulls[1] = pull_request(1, head_sha='b', updated_at='2016-02-02T12:00:00Z')
+        self.server.pulls[2]['updated_at'] = '2016-02-02T12:00:00Z'  # e.g. commented on; the diff is the same
+        os.remove(os.path.join(self.repo_build_dir, 'html', 'student3-patch.html'))
+        self.assertEqual(self.run_main(), (1, 2))
+        with open(os.path.join(self.repo_build_dir, 'patches', 'student1.patch')) as f:
+            self.assertEqual(f.read(), self.server.pulls[1]['diff'] + '\n')
+        self.assertEqual(self.run_main(), (0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
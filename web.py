@@ -1,21 +1,34 @@
 #!/usr/bin/env python
 
+import argparse
+import gzip
+import hashlib
+import io
+import json
 import re
 import os
-from collections import namedtuple
+import threading
+import zipfile
+from collections import OrderedDict, namedtuple
 from glob import glob
 
 import flask
 from flask import Flask
 
-import nbformat
-import nbconvert
 import pandas as pd
 
+from tools.disk_cache import CacheStore
+from tools.notebook_html import render_notebook_html, split_question_chunks
+from tools.semester_index import SemesterIndex, natural_sort_key
+from tools.summary_bundle import bundle_path, read_summary_bundle
+
 COURSE_NAME = 'SoftDes Spring 2016'
 
 PROJECT_DIR = os.path.dirname(__file__)
 SUMMARY_DIR = os.path.join(PROJECT_DIR, 'summaries')
+PROCESSED_NOTEBOOK_DIR = os.path.join(PROJECT_DIR, 'processed_notebooks')
+CACHE_DIR = os.path.join(PROJECT_DIR, '_cache')
+SEMESTER_INDEX_PATH = os.path.join(SUMMARY_DIR, 'semester_index.pickle')
 
 DATAFRAME_TABLE_CLASSES = 'table-condensed table-striped table-hover'
 
@@ -26,30 +39,178 @@ GITHUB_REPO_URL = 'https://github.com/sd16spring/ReadingJournal'
 
 Assignment = namedtuple('Assignment', ['assignment_id', 'name', 'summaries', 'notebook_name'])
 
+# A rendered response body. `version` identifies the inputs it was rendered from, e.g. a file's mtime.
+RenderedPage = namedtuple('RenderedPage', ['version', 'etag', 'body', 'gzipped_body'])
+
 app = Flask(__name__)
 
 pd.set_option('display.max_colwidth', -1)
 
-assignments = {}
 
-for path in glob(os.path.join(SUMMARY_DIR, '*.csv')):
-    m = RESPONSE_SUMMARY_PATH_TEMPLATE_RE.match(os.path.basename(path))
-    if not m:
-        continue
-    assignment_id, summary_type = m.groups()
-    df = pd.read_csv(path, index_col=0)
-    assignment = assignments.get(assignment_id)
-    if not assignment:
-        assignment_name = assignment_id.replace('day', 'day ').capitalize()
-        assignment = Assignment(assignment_id, assignment_name, [], '%s_reading_journal.ipynb' % assignment_id)
-        assignments[assignment_id] = assignment
-    assignment[2].append((summary_type, df))
+class LRUCache(object):
+    """ A thread-safe mapping that keeps at most `max_entries` values, dropping the least recently used. """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # least recently used first
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            value = self._entries.pop(key)
+            self._entries[key] = value
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class AssignmentRegistry(object):
+    """ The assignments that have summaries in a directory.
+
+        Only file names are read when the directory is scanned. A summary's DataFrame is
+        read on first use, and read again when its file's mtime changes. At most
+        `max_loaded` DataFrames, and as many rendered tables, are kept in memory; the least
+        recently used are dropped.
+
+        A summary is read from the binary bundle next to its CSV file, unless the bundle
+        is missing or older than the CSV file. """
+
+    def __init__(self, summary_dir, max_loaded=32):
+        self.summary_dir = summary_dir
+        self.max_loaded = max_loaded
+        self._assignments = {}
+        self._scanned_mtime = None
+        self._dataframes = LRUCache(max_loaded)  # path -> ((source path, mtime), DataFrame)
+        self._table_fragments = LRUCache(max_loaded)  # path -> ((source path, mtime), HTML table)
+
+    def scan(self):
+        """Re-reads the list of summary files, if the directory has changed since the last scan."""
+        try:
+            dir_mtime = os.path.getmtime(self.summary_dir)
+        except OSError:
+            dir_mtime = None
+        if dir_mtime == self._scanned_mtime and self._scanned_mtime is not None:
+            return
+        assignments = {}
+        for path in sorted(glob(os.path.join(self.summary_dir, '*.csv'))):
+            m = RESPONSE_SUMMARY_PATH_TEMPLATE_RE.match(os.path.basename(path))
+            if not m:
+                continue
+            assignment_id, summary_type = m.groups()
+            assignment = assignments.get(assignment_id)
+            if not assignment:
+                assignment_name = assignment_id.replace('day', 'day ').capitalize()
+                assignment = Assignment(assignment_id, assignment_name, [], '%s_reading_journal.ipynb' % assignment_id)
+                assignments[assignment_id] = assignment
+            assignment[2].append((summary_type, path))
+        self._assignments = assignments
+        self._scanned_mtime = dir_mtime
+
+    def assignments(self):
+        self.scan()
+        return self._assignments.values()
+
+    def get(self, assignment_id):
+        """Returns the Assignment, whose summaries are `(summary_type, path)` pairs; or None."""
+        self.scan()
+        return self._assignments.get(assignment_id)
 
+    @staticmethod
+    def summary_source(path):
+        """Returns `(source path, mtime)` for the summary whose CSV file is at `path`."""
+        mtime = os.path.getmtime(path)
+        try:
+            source_path = bundle_path(path)
+            source_mtime = os.path.getmtime(source_path)
+            if source_mtime >= mtime:
+                return source_path, source_mtime
+        except OSError:
+            pass
+        return path, mtime
 
-def natural_sort_key(s):
-    int_re = re.compile(r'(-?\d+)')
-    return tuple(int(c) if int_re.match(c) else c
-                 for c in int_re.split(s))
+    def dataframe(self, path):
+        """Returns the DataFrame for the summary whose CSV file is at `path`."""
+        source_path, mtime = self.summary_source(path)
+        entry = self._dataframes.get(path)
+        if entry is None or entry[0] != (source_path, mtime):
+            df = None
+            if source_path != path:
+                try:
+                    df = read_summary_bundle(source_path)
+                except (IOError, ValueError, zipfile.BadZipfile):
+                    pass  # e.g. not readable by this user, or written by another version; read the CSV
+            if df is None:
+                df = pd.read_csv(path, index_col=0)
+            entry = ((source_path, mtime), df)
+            self._dataframes.put(path, entry)
+        return entry[1]
+
+    def table_html(self, path):
+        """Returns the HTML table for the summary file at `path`. It is rendered again only when the
+        summary's mtime changes; the DataFrame itself isn't read for a cached table."""
+        version = self.summary_source(path)
+        entry = self._table_fragments.get(path)
+        if entry is None or entry[0] != version:
+            entry = (version, self.dataframe(path).to_html(classes=DATAFRAME_TABLE_CLASSES))
+            self._table_fragments.put(path, entry)
+        return entry[1]
+
+
+assignments = AssignmentRegistry(SUMMARY_DIR)
+assignments.scan()
+
+semester_index = SemesterIndex.load(SEMESTER_INDEX_PATH)
+
+MAX_RENDERED_PAGES = 32
+rendered_pages = LRUCache(MAX_RENDERED_PAGES)  # key -> RenderedPage
+
+# HTML of each question's chunk of a processed notebook; shared with tools/extract_answers_template.py
+html_chunk_cache = CacheStore(os.path.join(CACHE_DIR, 'html_chunks'), max_bytes=256 * 2 ** 20, compress=True)
+
+
+def gzip_bytes(data):
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+def rendered_page(key, version, render_fn):
+    """Returns the RenderedPage for `key`. `render_fn` is called to render it, if the cached page
+    is missing or was rendered from a different `version` of its inputs. With a `key` of None,
+    the page is rendered and not cached."""
+    page = rendered_pages.get(key) if key is not None else None
+    if page is None or page.version != version:
+        body = render_fn().encode('utf-8')
+        page = RenderedPage(version, hashlib.md5(body).hexdigest(), body, gzip_bytes(body))
+        if key is not None:
+            rendered_pages.put(key, page)
+    return page
+
+
+def page_response(page, mimetype='text/html'):
+    """Returns a response for a RenderedPage: 304 if the client has it, gzipped if the client accepts that."""
+    use_gzip = 'gzip' in flask.request.headers.get('Accept-Encoding', '')
+    etag = page.etag + ('-gzip' if use_gzip else '')
+    if etag in flask.request.if_none_match:
+        response = flask.Response(status=304)
+    else:
+        response = flask.Response(page.gzipped_body if use_gzip else page.body, mimetype=mimetype)
+        if use_gzip:
+            response.headers['Content-Encoding'] = 'gzip'
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
 
 
 @app.route('/')
@@ -58,7 +219,7 @@ def index():
         'index.html',
         course_name=COURSE_NAME,
         title='Assignments',
-        assignments=sorted(assignments.values(), key=lambda t: natural_sort_key(t[1]))
+        assignments=sorted(assignments.assignments(), key=lambda t: natural_sort_key(t[1]))
     )
 
 
@@ -66,34 +227,180 @@ def index():
 def assignment(assignment_id):
     def summary_type_to_title(s):
         return s.replace('_', ' ').capitalize()
-    assignment = assignments[assignment_id]
-    tables = [(summary_type != 'response_counts',
-               summary_type_to_title(summary_type),
-               df.to_html(classes=DATAFRAME_TABLE_CLASSES))
-              for summary_type, df in assignment[2]]
-    return flask.render_template(
-        'assignment.html',
-        assignment=assignment,
-        notebook_url='/'.join([GITHUB_REPO_URL, 'blob/master', assignment.notebook_name]),
-        course_name=COURSE_NAME,
-        title=assignment.name,
-        tables=[(title, df) for is_poll, title, df in tables if not is_poll],
-        polls=[(title, df) for is_poll, title, df in tables if is_poll],
-        )
+    assignment = assignments.get(assignment_id)
+    if not assignment:
+        flask.abort(404)
+
+    def render():
+        tables = [(summary_type != 'response_counts',
+                   summary_type_to_title(summary_type),
+                   assignments.table_html(path))
+                  for summary_type, path in assignment[2]]
+        return flask.render_template(
+            'assignment.html',
+            assignment=assignment,
+            notebook_url='/'.join([GITHUB_REPO_URL, 'blob/master', assignment.notebook_name]),
+            course_name=COURSE_NAME,
+            title=assignment.name,
+            tables=[(title, df) for is_poll, title, df in tables if not is_poll],
+            polls=[(title, df) for is_poll, title, df in tables if is_poll],
+            )
+    version = tuple(assignments.summary_source(path) for _, path in assignment[2])
+    return page_response(rendered_page(('assignment', assignment_id), version, render))
+
+
+def processed_notebook_path(assignment_id):
+    return os.path.join(PROCESSED_NOTEBOOK_DIR, '%s_reading_journal_responses.ipynb' % assignment_id)
+
+
+def render_processed_notebook_page(assignment_id):
+    """Returns the RenderedPage for an assignment's processed notebook, rendering it if the
+    notebook file has changed since it was last rendered."""
+    path = processed_notebook_path(assignment_id)
+
+    def render():
+        with io.open(path, encoding='utf-8') as f:
+            nb = json.load(f)
+        nb_html = render_notebook_html(nb.get('metadata', {}), split_question_chunks(nb['cells']),
+                                       store=html_chunk_cache)
+        assignment_name = assignments.get(assignment_id)[1]
+        return flask.render_template(
+            'processed_notebook.html',
+            course_name=COURSE_NAME,
+            title=' '.join([assignment_name, 'Processed Notebook']),
+            nb_html=nb_html)
+    return rendered_page(('processed_notebook', assignment_id), os.path.getmtime(path), render)
 
 
 @app.route('/assignment/<assignment_id>/processed')
 def processed_notebook(assignment_id):
-    with open('processed_notebooks/%s_reading_journal_responses.ipynb' % assignment_id) as f:
-        nb = nbformat.reads(f.read(), as_version=4)
-    str, _ = nbconvert.export_html(nb)
-    assignment_name = assignments[assignment_id][1]
-    return flask.render_template(
-        'processed_notebook.html',
-        course_name=COURSE_NAME,
-        title=' '.join([assignment_name, 'Processed Notebook']),
-        nb_html=str)
+    if not assignments.get(assignment_id) or not os.path.exists(processed_notebook_path(assignment_id)):
+        flask.abort(404)
+    return page_response(render_processed_notebook_page(assignment_id))
+
+
+@app.route('/semester')
+def semester():
+    """Per-student totals across every assignment. `?min_missed=N` lists only the students who
+    missed at least N mandatory questions."""
+    min_missed = flask.request.args.get('min_missed', 0, type=int)
+    semester_index.reload()
+
+    def render():
+        return flask.render_template(
+            'semester.html',
+            course_name=COURSE_NAME,
+            title='Semester',
+            min_missed=min_missed,
+            table=semester_index.student_summary(min_missed).to_html(classes=DATAFRAME_TABLE_CLASSES))
+    # Only the unfiltered page is cached, so that arbitrary query values can't fill the cache.
+    cache_key = ('semester',) if min_missed == 0 else None
+    return page_response(rendered_page(cache_key, semester_index.mtime, render))
+
+
+API_DEFAULT_PAGE_SIZE = 100
+API_MAX_PAGE_SIZE = 1000
+
+
+def json_value(value):
+    """Converts a DataFrame cell to a JSON-serializable value."""
+    if hasattr(value, 'item'):
+        value = value.item()  # numpy scalar
+    if isinstance(value, float) and value != value:
+        return None  # NaN
+    return value
+
+
+def summary_records(df, summary_type, students=None, questions=None, columns=None):
+    """Returns `(columns, df)`: the filtered summary DataFrame, and the names of its fields, the first
+    of which is the index, i.e. the question for response counts, and the student for polls.
+
+    `students` and `questions` are lists of names to filter by; `columns` selects columns."""
+    if summary_type == 'response_counts':
+        row_filter, column_filter = questions, students
+        index_name = 'Question'
+    else:
+        row_filter, column_filter = students, None
+        index_name = df.index.name or 'Student'
+    if row_filter:
+        df = df[df.index.isin(row_filter)]
+    selected_columns = [c for c in df.columns
+                        if (not column_filter or c in column_filter or c == 'Total') and
+                        (not columns or c in columns)]
+    df = df[selected_columns]
+    return [index_name] + selected_columns, df
+
+
+def iter_summary_rows(columns, df):
+    for row in df.itertuples():
+        yield OrderedDict(zip(columns, map(json_value, row)))
+
+
+@app.route('/api/assignments')
+def api_assignments():
+    return flask.jsonify(assignments=[
+        {'assignment_id': assignment.assignment_id,
+         'name': assignment.name,
+         'summaries': [summary_type for summary_type, _ in assignment.summaries]}
+        for assignment in sorted(assignments.assignments(), key=lambda t: natural_sort_key(t[1]))])
+
+
+@app.route('/api/assignment/<assignment_id>/<summary_type>')
+def api_summary(assignment_id, summary_type):
+    """Returns the rows of a summary, e.g. `response_counts`, or a poll.
+
+    Query parameters: `offset` and `limit` page through the rows; `columns` is a comma-separated list
+    of columns; `student` and `question` filter by name, and can be repeated; `format=ndjson` streams
+    one JSON object per line instead of returning a single JSON document. An NDJSON stream isn't
+    limited to a page of rows unless `limit` is given."""
+    assignment = assignments.get(assignment_id)
+    paths = dict(assignment.summaries) if assignment else {}
+    if summary_type not in paths:
+        flask.abort(404)
+    args = flask.request.args
+    stream = args.get('format') == 'ndjson'
+    try:
+        offset = max(0, int(args.get('offset', 0)))
+        limit = args.get('limit')
+        if limit is not None:
+            limit = max(0, int(limit))
+        if not stream:
+            limit = min(API_MAX_PAGE_SIZE, API_DEFAULT_PAGE_SIZE if limit is None else limit)
+    except ValueError:
+        flask.abort(400)
+    columns, df = summary_records(assignments.dataframe(paths[summary_type]), summary_type,
+                                  students=args.getlist('student'),
+                                  questions=args.getlist('question'),
+                                  columns=[c for c in args.get('columns', '').split(',') if c])
+    page = df.iloc[offset:] if limit is None else df.iloc[offset:offset + limit]
+
+    if stream:
+        def generate():
+            for row in iter_summary_rows(columns, page):
+                yield json.dumps(row) + '\n'
+        return flask.Response(flask.stream_with_context(generate()), mimetype='application/x-ndjson')
+    return flask.jsonify(assignment_id=assignment_id,
+                         summary_type=summary_type,
+                         total=len(df),
+                         offset=offset,
+                         limit=limit,
+                         columns=columns,
+                         rows=list(iter_summary_rows(columns, page)))
+
+
+def warm_page_cache():
+    """Renders the processed notebook pages, so that the first views are served from the cache."""
+    with app.test_request_context():
+        for assignment_id, _, _, _ in assignments.assignments():
+            if os.path.exists(processed_notebook_path(assignment_id)):
+                print "Rendering", processed_notebook_path(assignment_id)
+                render_processed_notebook_page(assignment_id)
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the assignment summaries.')
+    parser.add_argument('--warm-cache', action='store_true', help='render the processed notebooks at startup')
+    args = parser.parse_args()
+    if args.warm_cache:
+        warm_page_cache()
     app.run(debug=True)